@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Compare index round trips: a new connection and request per query
+(how CheeseshopSource used to work) against the persistent connection
+and system.multicall batching it uses now.
+
+    python benchmarks/bench_metadata.py [packages]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import xmlrpclib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pbundler.cheesefile import Cheese
+from pbundler.metadata import MetadataCache
+from pbundler.sources import CheeseshopSource
+
+from index_server import IndexServer
+
+
+def make_packages(count):
+    packages = {}
+    for num in range(count):
+        name = 'pkg%04d' % (num,)
+        packages[name] = {}
+        for version in ['1.0', '1.1', '2.0']:
+            packages[name][version] = {'urls': [{
+                'packagetype': 'sdist', 'filename': '%s-%s.tar.gz' % (name, version),
+                'url': 'http://example.invalid/%s-%s.tar.gz' % (name, version),
+                'md5_digest': '0' * 32}]}
+    return packages
+
+
+def bench_one_by_one(server, cheeses):
+    for cheese in cheeses:
+        xmlrpclib.ServerProxy(server.url, xmlrpclib.Transport()).package_releases(cheese.name, True)
+    for cheese in cheeses:
+        xmlrpclib.ServerProxy(server.url, xmlrpclib.Transport()).release_urls(cheese.name, '2.0')
+
+
+def bench_source(server, cheeses):
+    cache_path = tempfile.mkdtemp(prefix='pbundle-bench')
+    try:
+        source = CheeseshopSource(server.url)
+        source.metadata_cache = MetadataCache(cache_path)
+        source.prefetch_versions(cheeses)
+        for cheese in cheeses:
+            source.available_versions(cheese)
+        pinned = [Cheese(cheese.name, '==2.0') for cheese in cheeses]
+        source.prefetch_release_urls(pinned)
+        for cheese in pinned:
+            source._call('release_urls', cheese.name, cheese.exact_version, immutable=True)
+    finally:
+        shutil.rmtree(cache_path)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200
+    server = IndexServer(make_packages(count)).start()
+    cheeses = [Cheese(name, None) for name in sorted(server.packages)]
+
+    for label, bench in [('one by one', bench_one_by_one), ('pbundler', bench_source)]:
+        server.reset_stats()
+        start = time.time()
+        bench(server, cheeses)
+        elapsed = time.time() - start
+        print("%-12s %6.3fs  connections=%d requests=%d calls=%d" % (
+            label, elapsed, server.stats.get('connections', 0),
+            server.stats.get('requests', 0), server.stats.get('calls', 0)))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,265 @@
+"""A stand-in package index, speaking the XML-RPC methods CheeseshopSource
+uses. Counts connections, HTTP requests and calls so round trips can be
+measured.
+
+Releases without 'urls' but with a 'size' get a synthetic sdist, made on
+first request and served by the same server under /packages/.
+
+StaticIndexServer serves the same packages as static files in the PEP 503
+layout SimpleIndexSource reads, answering conditional requests like a
+typical web server."""
+
+from __future__ import print_function
+
+import os
+import cgi
+import tarfile
+import hashlib
+import threading
+from StringIO import StringIO
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+
+class CountingRequestHandler(SimpleXMLRPCRequestHandler):
+    # allow keep-alive connections
+    protocol_version = 'HTTP/1.1'
+    # answer on any path, like .../pypi
+    rpc_paths = ()
+
+    def setup(self):
+        SimpleXMLRPCRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def do_POST(self):
+        self.server.count('requests')
+        SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def do_GET(self):
+        self.server.count('downloads')
+        data = self.server.artifacts.get(self.path.rsplit('/', 1)[-1])
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+SETUP_PY = """from setuptools import setup
+setup(name=%(name)r, version=%(version)r, packages=[%(module)r],
+      package_data={%(module)r: ['payload.bin']}, install_requires=%(requires)r)
+"""
+
+PKG_INFO = """Metadata-Version: 1.0
+Name: %(name)s
+Version: %(version)s
+Summary: synthetic benchmark package
+"""
+
+
+def make_sdist(name, version, requires, size):
+    """Returns the bytes of a .tar.gz sdist installing a package with a
+    payload of size (incompressible) bytes."""
+
+    params = {'name': name, 'version': version, 'module': name.replace('-', '_'),
+              'requires': list(requires)}
+    top = '%s-%s' % (name, version)
+    files = [
+        ('setup.py', SETUP_PY % params),
+        ('PKG-INFO', PKG_INFO % params),
+        ('%s/__init__.py' % (params['module'],), 'VERSION = %r\n' % (version,)),
+        ('%s/payload.bin' % (params['module'],), os.urandom(size)),
+        ]
+    out = StringIO()
+    with tarfile.open(fileobj=out, mode='w:gz') as archive:
+        for path, data in files:
+            info = tarfile.TarInfo('%s/%s' % (top, path))
+            info.size = len(data)
+            info.mode = 0o644
+            archive.addfile(info, StringIO(data))
+    return out.getvalue()
+
+
+def synthetic_packages(count, fanout=2, depth=3, size=4096):
+    """Returns (packages, toplevel names) for an IndexServer. Packages
+    are spread over depth layers; each package requires fanout packages
+    of the next layer."""
+
+    depth = max(1, min(depth, count))
+    layers = [[] for _ in range(depth)]
+    for num in range(count):
+        layers[num * depth // count].append('pkg%04d' % (num,))
+
+    packages = {}
+    for level, layer in enumerate(layers):
+        below = layers[level + 1] if level + 1 < depth else []
+        for num, name in enumerate(layer):
+            requires = []
+            if below:
+                requires = sorted(set(['%s>=1.0' % (below[(num * fanout + k) % len(below)],)
+                                       for k in range(fanout)]))
+            packages[name] = {'1.0': {'requires': requires, 'size': size}}
+    return packages, layers[0]
+
+
+class CountingMixIn(object):
+
+    def count(self, what):
+        with self._stats_lock:
+            self.stats[what] = self.stats.get(what, 0) + 1
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats = {}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class IndexServer(CountingMixIn, ThreadingMixIn, SimpleXMLRPCServer):
+    """packages maps names to {version: {'requires': [...], 'urls': [...]}}.
+    Instead of urls, a release can have the size of a synthetic sdist."""
+
+    daemon_threads = True
+
+    def __init__(self, packages, address=('127.0.0.1', 0)):
+        SimpleXMLRPCServer.__init__(self, address, CountingRequestHandler,
+                                    logRequests=False, allow_none=True)
+        self.packages = packages
+        # file name -> sdist bytes
+        self.artifacts = {}
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+        self.register_multicall_functions()
+        self.register_function(self.package_releases)
+        self.register_function(self.release_data)
+        self.register_function(self.release_urls)
+
+    @property
+    def url(self):
+        return 'http://%s:%d/pypi' % self.server_address
+
+    def _dispatch(self, method, params):
+        self.count('calls')
+        return SimpleXMLRPCServer._dispatch(self, method, params)
+
+    def package_releases(self, name, show_hidden=False):
+        return sorted(self.packages.get(name, {}).keys(), reverse=True)
+
+    def release_data(self, name, version):
+        return {'name': name, 'version': version,
+                'requires': self.packages[name][version].get('requires', [])}
+
+    def release_urls(self, name, version):
+        release = self.packages[name][version]
+        if 'urls' not in release and 'size' in release:
+            with self._stats_lock:
+                if 'urls' not in release:
+                    release['urls'] = [self._add_sdist(name, version, release)]
+        return release.get('urls', [])
+
+    def _add_sdist(self, name, version, release):
+        filename = '%s-%s.tar.gz' % (name, version)
+        data = make_sdist(name, version, release.get('requires', []), release['size'])
+        self.artifacts[filename] = data
+        return {'packagetype': 'sdist', 'filename': filename,
+                'url': 'http://%s:%d/packages/%s' % (self.server_address + (filename,)),
+                'md5_digest': hashlib.md5(data).hexdigest(),
+                'digests': {'md5': hashlib.md5(data).hexdigest(),
+                            'sha256': hashlib.sha256(data).hexdigest()}}
+
+
+SIMPLE_PAGE = """<!DOCTYPE html>
+<html><head><title>Links for %(name)s</title></head>
+<body><h1>Links for %(name)s</h1>
+%(links)s
+</body></html>
+"""
+
+
+def write_simple_index(packages, root):
+    """Write packages (with sizes, as for IndexServer) to root as a static
+    simple index: simple/<name>/index.html, linking to packages/."""
+
+    os.makedirs(os.path.join(root, 'packages'))
+    for name, releases in sorted(packages.items()):
+        links = []
+        for version, release in sorted(releases.items()):
+            filename = '%s-%s.tar.gz' % (name, version)
+            data = make_sdist(name, version, release.get('requires', []), release['size'])
+            with open(os.path.join(root, 'packages', filename), 'wb') as f:
+                f.write(data)
+            links.append('<a href="../../packages/%s#sha256=%s">%s</a><br/>' % (
+                filename, hashlib.sha256(data).hexdigest(), cgi.escape(filename)))
+        page_dir = os.path.join(root, 'simple', name)
+        os.makedirs(page_dir)
+        with open(os.path.join(page_dir, 'index.html'), 'w') as f:
+            f.write(SIMPLE_PAGE % {'name': cgi.escape(name), 'links': '\n'.join(links)})
+
+
+class StaticRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        SimpleHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        self.server.count('requests')
+        path = os.path.join(self.server.root, *[part for part in
+                            self.path.split('?', 1)[0].split('/') if part and part != '..'])
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404)
+            return None
+
+        st = os.fstat(f.fileno())
+        etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+        last_modified = self.date_time_string(int(st.st_mtime))
+        if (self.headers.get('If-None-Match') == etag or
+                self.headers.get('If-Modified-Since') == last_modified):
+            f.close()
+            self.server.count('not_modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(st.st_size))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        return f
+
+
+class StaticIndexServer(CountingMixIn, ThreadingMixIn, HTTPServer):
+    """Serves the files below root, as written by write_simple_index."""
+
+    daemon_threads = True
+
+    def __init__(self, root, address=('127.0.0.1', 0)):
+        HTTPServer.__init__(self, address, StaticRequestHandler)
+        self.root = root
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%d/simple' % self.server_address
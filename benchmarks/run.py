@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""Time pbundler against a local index serving synthetic packages.
+
+    python benchmarks/run.py [--packages 50] [--fanout 2] [--depth 3]
+                             [--size 4096] [--api xmlrpc|simple]
+                             [--repeat 3] [--output FILE]
+                             [--compare FILE] [--threshold PERCENT]
+
+Measures, each in a fresh process:
+
+  cold_install   pbundle install with an empty store
+  warm_install   pbundle install without Cheesefile.lock, store filled
+  enable         import pbundler and PBundler.setup()
+  lock_parse     CheesefileLock.parse()
+  exec_startup   pbundle exec python -c pass (needs pbundler installed)
+  python_startup python -c pass, for reference
+
+With --api simple, packages come from static files in the PEP 503 layout
+instead of the XML-RPC index.
+
+Results (all runs, min and median seconds) are written as JSON. With
+--compare, medians are compared against an earlier result file; with
+--threshold, the exit code is 1 if anything got slower by more than that
+many percent.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from index_server import IndexServer, StaticIndexServer, synthetic_packages, write_simple_index
+
+
+PBUNDLE = "import sys; from pbundler.cli import pbcli; sys.argv[0] = 'pbundle'; pbcli()"
+
+ENABLE = """import sys, time
+start = time.time()
+import pbundler
+pbundler.PBundler.setup(%r)
+sys.stdout.write('%%f' %% (time.time() - start))
+"""
+
+LOCK_PARSE = """import sys, time
+from pbundler.cheesefile import CheesefileLock
+start = time.time()
+CheesefileLock(%r).parse()
+sys.stdout.write('%%f' %% (time.time() - start))
+"""
+
+
+class Harness(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.packages, self.toplevel = synthetic_packages(
+            options.packages, options.fanout, options.depth, options.size)
+        self.workdir = tempfile.mkdtemp(prefix='pbundle-bench')
+        if options.api == 'simple':
+            static_root = os.path.join(self.workdir, 'index')
+            write_simple_index(self.packages, static_root)
+            self.server = StaticIndexServer(static_root).start()
+        else:
+            self.server = IndexServer(self.packages).start()
+        self.project = os.path.join(self.workdir, 'project')
+        self.store = os.path.join(self.workdir, 'store')
+        os.mkdir(self.project)
+        with open(os.path.join(self.project, 'Cheesefile'), 'w') as f:
+            f.write("source(%r, api=%r)\n" % (self.server.url, options.api))
+            for name in self.toplevel:
+                f.write("req(%r)\n" % (name,))
+        self.lock_path = os.path.join(self.project, 'Cheesefile.lock')
+
+    def close(self):
+        self.server.shutdown()
+        shutil.rmtree(self.workdir, True)
+
+    def env(self):
+        env = dict(os.environ)
+        env['PBUNDLER_STORE'] = self.store
+        env['PYTHONPATH'] = os.pathsep.join([ROOT] + [path for path in
+                                             [os.getenv('PYTHONPATH')] if path])
+        return env
+
+    def run(self, args, inner=False):
+        """Run args in the project, return the seconds it took, or the
+        seconds it printed with inner."""
+
+        start = time.time()
+        proc = subprocess.Popen(args, cwd=self.project, env=self.env(),
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        elapsed = time.time() - start
+        if proc.returncode != 0:
+            raise RuntimeError("%s failed:\n%s" % (' '.join(args), output))
+        if inner:
+            return float(output.strip().splitlines()[-1])
+        return elapsed
+
+    def pbundle(self, *args):
+        return self.run([sys.executable, '-c', PBUNDLE] + list(args))
+
+    def remove_lock(self):
+        if os.path.exists(self.lock_path):
+            os.unlink(self.lock_path)
+
+    def cold_install(self):
+        shutil.rmtree(self.store, True)
+        self.remove_lock()
+        self.server.reset_stats()
+        elapsed = self.pbundle('install')
+        self.index_stats = dict(self.server.stats)
+        return elapsed
+
+    def warm_install(self):
+        self.remove_lock()
+        return self.pbundle('install')
+
+    def enable(self):
+        return self.run([sys.executable, '-c', ENABLE % (self.project,)], inner=True)
+
+    def lock_parse(self):
+        return self.run([sys.executable, '-c', LOCK_PARSE % (self.lock_path,)], inner=True)
+
+    def exec_startup(self):
+        return self.pbundle('exec', sys.executable, '-c', 'pass')
+
+    def python_startup(self):
+        return self.run([sys.executable, '-c', 'pass'])
+
+    def can_exec(self):
+        # pbundle exec activates children through the installed pbundler
+        return self.run([sys.executable, '-c',
+                         "import pkg_resources; pkg_resources.get_distribution('pbundler')"]) and True
+
+    def measure(self):
+        results = {}
+        benchmarks = ['cold_install', 'warm_install', 'enable', 'lock_parse',
+                      'exec_startup', 'python_startup']
+        try:
+            self.can_exec()
+        except RuntimeError:
+            print("pbundler is not installed, skipping exec_startup.")
+            benchmarks.remove('exec_startup')
+
+        # cold installs leave the store filled for everything after them
+        for name in benchmarks:
+            runs = []
+            for num in range(self.options.repeat):
+                if name != 'cold_install' and not os.path.exists(self.lock_path):
+                    self.pbundle('install')
+                runs.append(getattr(self, name)())
+            results[name] = summarize(runs)
+            print("%-16s %9.3fs  (min %.3fs)" % (name, results[name]['median'], results[name]['min']))
+        return results
+
+
+def summarize(runs):
+    ordered = sorted(runs)
+    return {'runs': runs, 'min': ordered[0], 'median': ordered[len(ordered) // 2]}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old, threshold):
+    """Print medians next to those of old. Returns False if something
+    got slower by more than threshold percent."""
+
+    ok = True
+    print("\n%-16s %10s %10s %8s" % ('', 'before', 'now', 'change'))
+    for name in sorted(results):
+        if name not in old['results']:
+            continue
+        before = old['results'][name]['median']
+        now = results[name]['median']
+        change = (now - before) / before * 100 if before else 0.0
+        flag = ''
+        if threshold is not None and change > threshold:
+            flag = '  <-- slower'
+            ok = False
+        print("%-16s %9.3fs %9.3fs %+7.1f%%%s" % (name, before, now, change, flag))
+    return ok
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark pbundler.")
+    parser.add_argument('--packages', type=int, default=50)
+    parser.add_argument('--fanout', type=int, default=2)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--size', type=int, default=4096, help="payload bytes per sdist")
+    parser.add_argument('--api', choices=['xmlrpc', 'simple'], default='xmlrpc')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--threshold', type=float, metavar='PERCENT')
+    options = parser.parse_args(argv[1:])
+
+    harness = Harness(options)
+    try:
+        results = harness.measure()
+        index_stats = harness.index_stats
+    finally:
+        harness.close()
+
+    data = {
+        'commit': git_commit(),
+        'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+        'time': time.time(),
+        'params': {'packages': options.packages, 'fanout': options.fanout,
+                   'depth': options.depth, 'size': options.size, 'api': options.api,
+                   'repeat': options.repeat},
+        'index': index_stats,
+        'results': results,
+        }
+    with open(options.output, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    print("Wrote %s" % (options.output,))
+
+    if options.compare:
+        with open(options.compare) as f:
+            old = json.load(f)
+        if old.get('params') != data['params']:
+            print("Note: %s was measured with %r." % (options.compare, old.get('params')))
+        if not compare(results, old, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
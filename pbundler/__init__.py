@@ -5,6 +5,7 @@ __all__ = ['PBundler']
 from .exceptions import *
 from .bundle import Bundle
 from .cli import PBCli
+from .timing import profiler
 
 
 class PBundler(object):
@@ -22,9 +23,10 @@ class PBundler(object):
         environment.
 
         Returns the bundle."""
-        bundle = Bundle.load(path)
-        if groups is None:
-            groups = 'default'
-        bundle.enable(groups)
+        with profiler.span('setup'):
+            bundle = Bundle.load(path)
+            if groups is None:
+                groups = 'default'
+            bundle.enable(groups)
         return bundle
 
@@ -1,10 +1,55 @@
 from __future__ import print_function
 
+import os
 import traceback
 
+
+def activate_from_handoff(handoff):
+    """Apply the activation computed by `pbundle exec` in our parent.
+    Deliberately avoids importing pbundler, so no parsing or resolving
+    happens here.
+
+    Returns False if the Cheesefile or its lock changed since."""
+
+    import sys
+    import json
+    import ctypes
+    from hashlib import sha1
+
+    data = json.loads(handoff)
+
+    # Must match Bundle._activation_fingerprint.
+    stamps = []
+    for path in data['sources']:
+        try:
+            st = os.stat(path)
+            stamps.append('%s:%d:%d' % (path, st.st_size, int(st.st_mtime)))
+        except OSError:
+            stamps.append('%s:-' % (path,))
+    if sha1('\n'.join(stamps)).hexdigest() != data['fingerprint']:
+        return False
+
+    # Same as PyPath.builtin_path.
+    Py_GetPath = ctypes.pythonapi.Py_GetPath
+    if sys.version_info[0] >= 3:
+        Py_GetPath.restype = ctypes.c_wchar_p
+    else:
+        Py_GetPath.restype = ctypes.c_char_p
+
+    new_path = [sys.path[0]]
+    new_path.extend([str(path) for path in data['path']])
+    if data['bundler_path']:
+        new_path.append(str(data['bundler_path']))
+    new_path.extend(Py_GetPath().split(':'))
+    sys.path[:] = new_path
+    return True
+
+
 try:
-    import pbundler
-    pbundler.PBundler.setup()
+    handoff = os.getenv('PBUNDLER_ACTIVATION')
+    if not handoff or not activate_from_handoff(handoff):
+        import pbundler
+        pbundler.PBundler.setup()
 except:
     print("E: Exception in pbundler activation code.")
     print("")
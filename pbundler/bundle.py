@@ -5,13 +5,25 @@ __all__ = ['Bundle']
 
 import os
 import sys
+import json
+from hashlib import sha1
 
 from . import PBundlerException
 from .util import PBFile
 from .pypath import PyPath
-from .cheesefile import Cheesefile, CheesefileLock, Cheese, CHEESEFILE, CHEESEFILE_LOCK
-from .sources import FilesystemSource
+from .cheesefile import Cheesefile, CheesefileLock, CHEESEFILE, CHEESEFILE_LOCK
 from .localstore import LocalStore
+from .resolver import Resolver
+from .pack import BundlePack
+from .scheduler import BuildScheduler
+from .collector import StoreCollector
+from .mergedsite import MergedSite
+from .timing import profiler
+
+
+# Project-local copy of the bundle, laid out like a LocalStore. Kept
+# apart from the rest of .pbundle/, like environment.py.
+VENDOR_DIR = os.path.join('.pbundle', 'store')
 
 
 class Bundle:
@@ -30,6 +42,9 @@ class Bundle:
             self.cheesefile_lock = None
 
         self.localstore = LocalStore()
+        self._vendored_store = None
+        for source in self.cheesefile.sources:
+            source.metadata_cache = self.localstore.metadata_cache
 
     @classmethod
     def load(cls, path=None):
@@ -44,129 +59,177 @@ class Bundle:
 
         return cls(path)
 
-    def validate_requirements(self):
-        self.calculate_requirements()
-        pass
-
-    def _add_new_dep(self, dep):
-        cheese = Cheese.from_requirement(dep)
-        existing = self.required.get(cheese.key)
-        if existing:
-            # FIXME: check if we're compatible
-            return None
-        self.required[cheese.key] = cheese
-        return cheese
-
-    def _resolve_deps(self):
-        for pkg in self.required.values():
-            if pkg.source or pkg.dist:
-                # don't touch packages where we already know a source (& version)
-                continue
-
-            if pkg.path:
-                source = FilesystemSource(pkg.path)
-                available_versions = source.available_versions(pkg)
-                if len(available_versions) == 0:
-                    raise PBundlerException("Package %s is not available in %r" % (pkg.name, pkg.path))
-                if len(available_versions) != 1:
-                    raise PBundlerException("Package %s has multiple versions in %r" % (pkg.name, pkg.path))
-
-                version = available_versions[0]
-                pkg.use_from(version, source)
-
-            else:
-                req = pkg.requirement()
-                for source in self.cheesefile.sources:
-                    for version in source.available_versions(pkg):
-                        if version in req:
-                            pkg.use_from(version, source)
-                            break
-
-                if pkg.source is None:
-                    raise PBundlerException("Package %s %s is not available on any sources." % (pkg.name, pkg.version_req))
-
-        new_deps = []
+    @property
+    def vendored_store(self):
+        if self._vendored_store is None:
+            self._vendored_store = LocalStore(os.path.join(self.path, VENDOR_DIR))
+        return self._vendored_store
 
-        for pkg in self.required.values():
-            if pkg.dist:
-                # don't touch packages where we already have a (s)dist
-                continue
+    def is_vendored(self):
+        return os.path.isdir(os.path.join(self.path, VENDOR_DIR, 'cheese'))
 
-            if pkg.path:
-                # FIXME: not really the truth
-                dist = pkg.source.get_distribution(pkg.source)
-                print("Using %s %s from %s" % (pkg.name, pkg.exact_version, pkg.path))
-            else:
-                dist = self.localstore.get(pkg)
-                if dist:
-                    print("Using %s %s" % (pkg.name, pkg.exact_version))
-                else:
-                    # download and unpack
-                    dist = self.localstore.prepare(pkg, pkg.source)
+    def materialize(self):
+        """Link the resolved bundle into the project (.pbundle/store/), using
+        hard links or reflinks into the LocalStore. Activation then uses
+        the project-local tree. Only packages that changed are touched."""
 
-            pkg.use_dist(dist)
-
-            for dep in dist.requires():
-                new_deps.append(self._add_new_dep(dep))
-
-        # super ugly:
-        new_deps = list(set(new_deps))
-        if None in new_deps:
-            new_deps.remove(None)
-        return new_deps
-
-    def install(self, groups):
-        self.required = self.cheesefile.collect(groups, self.current_platform)
+        self.load_cheese()
+        vendored = self.vendored_store
+        packages = [pkg for pkg in self.required.values() if not pkg.path]
+
+        added = 0
+        for pkg in packages:
+            if self.localstore.link_entry(pkg, vendored):
+                added += 1
+            pkg.use_dist(vendored.get(pkg))
+        removed = vendored.remove_entries_except(packages)
+        self._build_merged_site()
+        print("Bundle in %s is up to date (%d added, %d removed)." %
+              (vendored.path, added, removed))
+
+    @staticmethod
+    def _use_merged_site():
+        return os.getenv('PBUNDLER_MERGED_SITE', '') not in ['', '0']
+
+    def _activation_store(self):
+        """The store activation takes packages from."""
+        if self.is_vendored():
+            return self.vendored_store
+        return self.localstore
+
+    def _build_merged_site(self):
+        """Build the merged site activation is going to look for, so
+        activation itself never writes to the store."""
+        if not self._use_merged_site():
+            return
+        stored = [pkg.dist for pkg in self.required.values() if not pkg.path]
+        if stored:
+            MergedSite(self._activation_store()).path_for(stored)
 
-        while True:
-            new_deps = self._resolve_deps()
-            if len(new_deps) == 0:
-                # done resolving!
-                break
+    def validate_requirements(self):
+        self.calculate_requirements()
+        pass
 
-        for pkg in self.required.values():
-            if getattr(pkg.dist, 'is_sdist', False) is True:
-                dist = self.localstore.install(pkg, pkg.dist)
-                pkg.use_dist(dist)  # mark as installed
+    def install(self, groups, vendor=False):
+        required = self.cheesefile.collect(groups, self.current_platform)
+        with profiler.span('resolve'):
+            self.required = Resolver(self.cheesefile.sources, self.localstore).resolve(required)
+
+        # packages resolved from recorded metadata still need their sdist
+        with profiler.span('fetch'):
+            unprepared = [pkg for pkg in self.required.values() if pkg.dist is None]
+            sdist_filepaths = self.localstore.download(unprepared)
+            for pkg in unprepared:
+                pkg.use_dist(self.localstore.prepare(pkg, pkg.source, sdist_filepaths[pkg.key]))
+
+        with profiler.span('build'):
+            sdists = [pkg for pkg in self.required.values()
+                      if getattr(pkg.dist, 'is_sdist', False) is True]
+            BuildScheduler(self.localstore).run(sdists, self.required)
+
+        with profiler.span('write lock'):
+            self._write_cheesefile_lock(groups)
+        self._record_use()
+        if vendor or self.is_vendored():
+            self.materialize()
+        else:
+            self._build_merged_site()
+        evicted = StoreCollector.collect_automatically(self.localstore)
+        if evicted:
+            print("Evicted %d unused packages and downloads from %s." %
+                  (len(evicted), self.localstore.path))
+        # sources of packages we ended up not needing
+        self.localstore.cleanup()
+        print("Your bundle is complete.")
 
-        self._write_cheesefile_lock()
+    def install_from_pack(self, path):
+        """Populate the store from a pack made by 'pbundle pack' and use
+        its lock. Needs no network and builds nothing."""
+
+        BundlePack(path).extract(self.localstore, self.path)
+        self.cheesefile_lock = CheesefileLock(os.path.join(self.path, CHEESEFILE_LOCK))
+        self.cheesefile_lock.parse()
+        if not self._load_from_lock(['default'], self.localstore):
+            raise PBundlerException("%s does not match this Cheesefile." % (path,))
+        self._record_use()
+        if self.is_vendored():
+            self.materialize()
+        else:
+            self._build_merged_site()
         print("Your bundle is complete.")
 
-    def _write_cheesefile_lock(self):
-        # TODO: file format is wrong. at least we must consider groups,
-        # and we shouldn't rewrite the entire file (think groups, platforms).
-        # TODO: write source to lockfile.
-        with file(os.path.join(self.path, CHEESEFILE_LOCK), 'wt') as lockfile:
-            indent = ' '*4
-            lockfile.write("with Cheesefile():\n")
-            packages = self.cheesefile.collect(['default'], self.current_platform)
-            for pkg in packages.itervalues():
-                lockfile.write(indent+"req(%r, %r, path=%r)\n" % (pkg.name, pkg.exact_version, pkg.path))
-            if not packages:
-                lockfile.write(indent+"pass\n")
-            lockfile.write("\n")
-
-            for source in self.cheesefile.sources:
-                lockfile.write("with from_source(%r):\n" % (source.url))
-                for name, pkg in self.required.items():
-                    # ignore ourselves and our dependencies (which should
-                    # only ever be distribute).
-                    if name in ['pbundler','distribute']:
-                        continue
-                    if pkg.source != source:
-                        continue
-                    lockfile.write(indent+"with resolved_req(%r, %r):\n" % (pkg.name, pkg.exact_version))
-                    for dep in pkg.requirements:
-                        lockfile.write(indent+indent+"req(%r, %r)\n" % (dep.name, dep.version_req))
-                    if not pkg.requirements:
-                        lockfile.write(indent+indent+"pass\n")
-                if not self.cheesefile.sources:
-                    lockfile.write(indent+"pass\n")
+    def update(self):
+        """Install, asking the sources for new versions instead of using
+        cached answers."""
+
+        self.localstore.metadata_cache.refresh = True
+        self.install(['default'])
+
+    def _group_membership(self, groups):
+        """Returns key -> set of groups needing that package."""
+
+        membership = {}
+        for group in groups:
+            todo = self.cheesefile.collect([group], self.current_platform).keys()
+            while todo:
+                key = todo.pop()
+                if key not in self.required or group in membership.get(key, ()):
+                    continue
+                membership.setdefault(key, set()).add(group)
+                todo.extend([dep.key for dep in self.required[key].requirements])
+        return membership
+
+    def _write_cheesefile_lock(self, groups):
+        toplevel = {}
+        for group in groups:
+            pkgs = self.cheesefile.collect([group], self.current_platform).values()
+            toplevel[group] = [{'name': pkg.name, 'version': pkg.exact_version,
+                                'path': pkg.path, 'platform': pkg.platform}
+                               for pkg in sorted(pkgs, key=lambda pkg: pkg.key)]
+
+        membership = self._group_membership(groups)
+        entries = self.localstore.index['entries'].get(self.localstore.python_name, {})
+        packages = {}
+        for key, pkg in self.required.items():
+            # ignore ourselves and our dependencies (which should only
+            # ever be distribute).
+            if key in ['pbundler', 'distribute']:
+                continue
+            entry = {
+                'name': pkg.name,
+                'version': pkg.exact_version,
+                'source': None,
+                'path': pkg.path,
+                'platform': pkg.platform,
+                'groups': sorted(membership.get(key, groups)),
+                'requires': sorted(['%s%s' % (dep.name, dep.version_req or '')
+                                    for dep in pkg.requirements]),
+                'digests': None,
+                'location': None,
+                'egg_info': None,
+                }
+            if not pkg.path:
+                entry['source'] = pkg.source.url
+                record = self.localstore.get_metadata(pkg)
+                if record is not None:
+                    entry['digests'] = record['digests']
+                stored = entries.get(self.localstore.entry_name(pkg))
+                if stored is not None:
+                    entry['location'] = stored['location']
+                    entry['egg_info'] = stored['egg_info']
+            packages[key] = entry
+
+        if self.cheesefile_lock is None or self.cheesefile_lock.data is None:
+            # new, or written by an older pbundler
+            self.cheesefile_lock = CheesefileLock(os.path.join(self.path, CHEESEFILE_LOCK))
+        self.cheesefile_lock.update(self.localstore.python_name,
+                                    [source.url for source in self.cheesefile.sources],
+                                    toplevel, packages)
 
     def _check_sys_modules_is_clean(self):
         # TODO: Possibly remove this when resolver/activation development is done.
         unclean = []
-        for name, module in sys.modules.iteritems():
+        for name, module in sys.modules.items():
             source = getattr(module, '__file__', None)
             if source is None or name == '__main__':
                 continue
@@ -181,31 +244,136 @@ class Bundle:
         if len(unclean) > 0:
             raise PBundlerException("sys.modules contains foreign modules: %s" % ','.join(unclean))
 
+    def _load_from_lock(self, groups, store=None):
+        """Rebuild self.required from the Cheesefile.lock and the
+        LocalStore (by default the project-local one, if there is one),
+        without resolving anything. Packages are taken from where the lock
+        says they are installed; the store index is only asked for those
+        the lock has no (valid) location for.
+
+        Returns False if the lock is stale or packages are missing."""
+
+        if self.cheesefile_lock is None:
+            return False
+        if self.cheesefile_lock.is_stale(self.cheesefile, groups, self.current_platform):
+            return False
+
+        if store is None:
+            store = self._activation_store()
+
+        required = self.cheesefile_lock.resolved(self.cheesefile.sources, groups,
+                                                 self.current_platform)
+        for pkg in required.values():
+            if pkg.path:
+                dist = pkg.source.get_distribution(pkg)
+            else:
+                dist = None
+                recorded = self.cheesefile_lock.recorded_location(pkg)
+                if recorded is not None:
+                    dist = store.get_recorded(pkg, *recorded)
+                if dist is None:
+                    dist = store.get(pkg)
+            if dist is None:
+                return False
+            pkg.use_dist(dist)
+
+        self.required = required
+        return True
+
+    def _record_use(self):
+        """Protect our packages from 'pbundle gc' and mark them as
+        recently used."""
+        self.localstore.register_project(os.path.join(self.path, CHEESEFILE_LOCK))
+        self.localstore.touch([pkg for pkg in self.required.values() if not pkg.path])
+
+    def _register_activation(self):
+        """Protect our packages from 'pbundle gc', for projects that
+        were never installed from this store (like fresh checkouts with
+        a lock). Writes nothing for registered projects, and is skipped
+        where the store is read-only: activation must work there."""
+        try:
+            self.localstore.register_project(os.path.join(self.path, CHEESEFILE_LOCK))
+        except (IOError, OSError):
+            pass
+
     def load_cheese(self):
         if getattr(self, 'required', None) is None:
-            # while we don't have a lockfile reader:
+            with profiler.span('load from lock'):
+                loaded = self._load_from_lock(['default'])
+            if loaded:
+                self._register_activation()
+                return
+            if self.is_vendored() and self._load_from_lock(['default'], self.localstore):
+                # the project-local copy is behind the lock
+                self.materialize()
+                return
+            # lock is stale or the store is missing packages.
             self.install(['default'])
-            #raise PBundlerException("Your bundle is not installed.")
 
     def enable(self, groups):
         # TODO: remove groups from method sig
         self.load_cheese()
 
-        # reset import path
-        new_path = [sys.path[0]]
-        new_path.extend(PyPath.clean_path())
-        PyPath.replace_sys_path(new_path)
+        with profiler.span('sys.path'):
+            # reset import path
+            new_path = [sys.path[0]]
+            new_path.extend(PyPath.clean_path())
+            PyPath.replace_sys_path(new_path)
+
+            new_path = [sys.path[0]]
+            new_path.extend(self._enabled_path())
+            new_path.extend(PyPath.clean_path())
+            PyPath.replace_sys_path(new_path)
 
+        self._check_sys_modules_is_clean()
+
+    def _enabled_path(self):
         enabled_path = []
-        for pkg in self.required.values():
+        pkgs = self.required.values()
+        if self._use_merged_site():
+            # one directory for everything from the store. packages
+            # from a path can change any time, so they stay separate.
+            # the site is built by installs; without it, packages are
+            # activated one by one.
+            stored = [pkg.dist for pkg in pkgs if not pkg.path]
+            site_path = None
+            if stored:
+                site_path = MergedSite(self._activation_store()).lookup(stored)
+            if site_path is not None:
+                enabled_path.append(site_path)
+                pkgs = [pkg for pkg in pkgs if pkg.path]
+        for pkg in pkgs:
             pkg.dist.activate(enabled_path)
+        return enabled_path
+
+    @staticmethod
+    def _activation_fingerprint(paths):
+        """Fingerprint of the files an activation was computed from.
+        Must match the computation in activation/sitecustomize.py."""
+
+        stamps = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamps.append('%s:%d:%d' % (path, st.st_size, int(st.st_mtime)))
+            except OSError:
+                stamps.append('%s:-' % (path,))
+        return sha1('\n'.join(stamps)).hexdigest()
+
+    def activation_handoff(self):
+        """Serialize the activation result, so child processes can
+        apply it without parsing or resolving anything."""
 
-        new_path = [sys.path[0]]
-        new_path.extend(enabled_path)
-        new_path.extend(PyPath.clean_path())
-        PyPath.replace_sys_path(new_path)
-
-        self._check_sys_modules_is_clean()
+        self.load_cheese()
+        sources = [self.cheesefile.path, os.path.join(self.path, CHEESEFILE_LOCK)]
+        data = {
+            'sources': sources,
+            'fingerprint': self._activation_fingerprint(sources),
+            'path': self._enabled_path(),
+            'bundler_path': PyPath.bundler_path(),
+            'dists': dict((pkg.name, pkg.dist.location) for pkg in self.required.values()),
+            }
+        return json.dumps(data)
 
     def exec_enabled(self, command):
         # We don't actually need all the cheese loaded, but it's great to
@@ -217,6 +385,9 @@ class Bundle:
         activation_path = os.path.join(dist.location, 'pbundler', 'activation')
         os.putenv('PYTHONPATH', activation_path)
         os.putenv('PBUNDLER_CHEESEFILE', self.cheesefile.path)
+        os.putenv('PBUNDLER_ACTIVATION', self.activation_handoff())
+        # exec doesn't run atexit handlers
+        profiler.write()
         os.execvp(command[0], command)
 
     def get_cheese(self, name, default=None):
@@ -1,9 +1,11 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
-__all__ = ['Cheesefile', 'Cheese', 'CHEESEFILE', 'CHEESEFILE_LOCK']
+__all__ = ['Cheesefile', 'CheesefileLock', 'Cheese', 'CHEESEFILE', 'CHEESEFILE_LOCK']
 
 import os
+import re
+import json
 from contextlib import contextmanager
 import pkg_resources
 
@@ -11,12 +13,16 @@ from pip.req import parse_requirements
 
 from . import PBundlerException
 from .dsl import DslRunner
-from .sources import CheeseshopSource
+from .sources import CheeseshopSource, SimpleIndexSource, DirectorySource, FilesystemSource
+from .timing import profiler
 
 
 CHEESEFILE = 'Cheesefile'
 CHEESEFILE_LOCK = 'Cheesefile.lock'
 
+# Version of the JSON lock format.
+LOCK_FORMAT = 1
+
 
 class Cheese(object):
     """A package. A distribution. A requirement. A cheese.
@@ -31,6 +37,8 @@ class Cheese(object):
         self.source = source
         self.dist = None
         self._requirements = None
+        # (version_req, Requirement) we were created from
+        self._parsed = None
         self.key = self.name.lower()
 
     @classmethod
@@ -38,7 +46,9 @@ class Cheese(object):
         version = ','.join([op + ver for (op, ver) in req.specs])
         if version == '':
             version = None
-        return cls(req.project_name, version, None, None)
+        cheese = cls(req.project_name, version, None, None)
+        cheese._parsed = (version, req)
+        return cheese
 
     def applies_to(self, platform):
         if self.platform is None:
@@ -69,6 +79,9 @@ class Cheese(object):
     def requirement(self):
         """Return pkg_resources.Requirement matching this object."""
 
+        if self._parsed is not None and self._parsed[0] == self.version_req:
+            return self._parsed[1]
+
         version = self.version_req
         if version is None:
             version = ''
@@ -79,8 +92,8 @@ class Cheese(object):
 
     @property
     def requirements(self):
-        assert(self.dist is not None)
         if self._requirements is None:
+            assert(self.dist is not None)
             self._requirements = [Cheese.from_requirement(dep) for dep in self.dist.requires()]
         return self._requirements
 
@@ -116,11 +129,26 @@ class CheesefileContext(object):
 
         return "\n".join(s)
 
-    def source(self, name_or_url):
+    def source(self, name_or_url, api=None):
+        """A package index, or a directory of sdists. Indexes are asked
+        through XML-RPC, unless api='simple' is given or the URL ends in
+        /simple."""
+
         if name_or_url == 'pypi':
             name_or_url = 'http://pypi.python.org/pypi'
 
-        self.sources.append(CheeseshopSource(name_or_url))
+        if api not in (None, 'xmlrpc', 'simple'):
+            raise PBundlerException("Unknown index API %r for %s." % (api, name_or_url))
+        if '://' in name_or_url and not name_or_url.startswith('file://'):
+            if api is None and name_or_url.rstrip('/').endswith('/simple'):
+                api = 'simple'
+            if api == 'simple':
+                self.sources.append(SimpleIndexSource(name_or_url))
+            else:
+                self.sources.append(CheeseshopSource(name_or_url))
+        else:
+            # a directory of sdists
+            self.sources.append(DirectorySource(name_or_url, os.path.dirname(self.path)))
 
     @contextmanager
     def group(self, name):
@@ -215,20 +243,206 @@ class CheesefileLockContext(object):
     def resolved_req(self, name, version):
         prev_req_context = self.current_req_context
         solved_req = Cheese(name, version)
-        self.current_req_context = solved_req.requirements
+        solved_req._requirements = []
+        self.current_req_context = solved_req._requirements
         yield
         self.current_req_context = prev_req_context
         self.current_req_context.append(solved_req)
 
 
+def split_requirement(spec):
+    """'foo>=1.0,<2' -> ('foo', '>=1.0,<2'). Much cheaper than
+    pkg_resources.Requirement.parse."""
+    name, version_req = re.match(r'([^<>=!~\s]+)\s*(.*)$', spec).groups()
+    return name, version_req or None
+
+
 class CheesefileLock(object):
-    """Parses and holds Cheesefile.locks."""
+    """Parses, holds and writes Cheesefile.locks.
+
+    Locks are JSON, holding:
+      format: LOCK_FORMAT
+      python: python_name of the store the packages were installed to
+      sources: URLs of the sources
+      cheesefile: group -> packages the Cheesefile asked for, as dicts
+        of name, version (the locked one), path and platform
+      packages: key -> dict of name, version, source (URL, or None for
+        packages from a path), path, platform, groups, requires (list of
+        requirement strings), digests (of the sdist, if known), and
+        location and egg_info (relative to the store)
+
+    Locks written as DSL code by older versions are still read.
+    """
 
     def __init__(self, path):
         self.path = path
+        # the JSON lock, or None for old locks
+        self.data = None
+        self._text = None
 
     def parse(self):
+        with file(self.path, 'rt') as f:
+            self._text = f.read()
+        if self._text.lstrip().startswith('{'):
+            with profiler.span('parse', path=self.path):
+                self._parse_json()
+        else:
+            self._parse_dsl()
+
+    def _parse_dsl(self):
         runner = DslRunner(CheesefileLockContext)
-        ctx = runner.execfile(self.path)
+        # the lock only declares things, so its result can be cached.
+        ctx = runner.execfile(self.path, cache_result=True)
         for attr, val in ctx.__dict__.items():
             self.__setattr__(attr, val)
+        self.toplevel = {'default': self.cheesefile_data}
+
+    def _parse_json(self):
+        try:
+            data = json.loads(self._text)
+        except ValueError as ex:
+            raise PBundlerException("%s is broken (%s)." % (self.path, ex))
+        if data.get('format') != LOCK_FORMAT:
+            raise PBundlerException("%s was written by a newer pbundler." % (self.path,))
+
+        self.data = data
+        self.toplevel = {}
+        for group, pkgs in data['cheesefile'].items():
+            self.toplevel[group] = [Cheese(pkg['name'], pkg['version'], pkg['platform'], pkg['path'])
+                                    for pkg in pkgs]
+        self.from_source_data = dict((url, []) for url in data['sources'])
+        for key, entry in sorted(data['packages'].items()):
+            if entry['source'] is None:
+                continue
+            solved = Cheese(entry['name'], entry['version'])
+            solved._requirements = self._requirements(entry)
+            self.from_source_data.setdefault(entry['source'], []).append(solved)
+
+    @staticmethod
+    def _requirements(entry):
+        return [Cheese(*split_requirement(spec)) for spec in entry['requires']]
+
+    def recorded_location(self, cheese):
+        """Returns (location, egg_info) recorded for cheese, or None."""
+
+        if self.data is None:
+            return None
+        entry = self.data['packages'].get(cheese.key)
+        if entry is None or not entry.get('location') or not entry.get('egg_info'):
+            return None
+        return (entry['location'], entry['egg_info'])
+
+    def is_stale(self, cheesefile, groups, platform):
+        """Returns True if the Cheesefile asks for something this lock
+        does not provide."""
+
+        if [group for group in groups if group not in self.toplevel]:
+            return True
+
+        wanted = cheesefile.collect(groups, platform)
+        locked = {}
+        for group in groups:
+            for pkg in self.toplevel[group]:
+                if pkg.applies_to(platform):
+                    locked[pkg.key] = pkg
+        if set(wanted.keys()) != set(locked.keys()):
+            return True
+
+        for key, pkg in wanted.items():
+            locked_pkg = locked[key]
+            if pkg.path != locked_pkg.path:
+                return True
+            if pkg.version_req is not None and locked_pkg.version_req not in pkg.requirement():
+                return True
+
+        source_urls = [source.url for source in cheesefile.sources]
+        for url in self.from_source_data:
+            if url not in source_urls:
+                return True
+
+        return False
+
+    def resolved(self, sources, groups=('default',), platform=None):
+        """Returns a dict of all Cheese recorded in the lock for groups
+        and platform, with exact versions and sources set. Sources are
+        matched by URL."""
+
+        sources = dict((source.url, source) for source in sources)
+        if self.data is None:
+            return self._resolved_dsl(sources)
+
+        required = {}
+        for key, entry in self.data['packages'].items():
+            if not set(entry['groups']).intersection(groups):
+                continue
+            if platform is not None and entry['platform'] not in (None, platform):
+                continue
+            if entry['path']:
+                cheese = Cheese(entry['name'], '==' + entry['version'], entry['platform'],
+                                entry['path'], FilesystemSource(entry['path']))
+            else:
+                cheese = Cheese(entry['name'], '==' + entry['version'], entry['platform'],
+                                source=sources[entry['source']])
+            cheese._requirements = self._requirements(entry)
+            required[cheese.key] = cheese
+        return required
+
+    def _resolved_dsl(self, sources):
+        required = {}
+
+        for pkg in self.cheesefile_data:
+            if not pkg.path:
+                continue
+            cheese = Cheese(pkg.name, '==' + pkg.version_req, pkg.platform, pkg.path,
+                            FilesystemSource(pkg.path))
+            required[cheese.key] = cheese
+
+        for url, pkgs in self.from_source_data.items():
+            for pkg in pkgs:
+                cheese = Cheese(pkg.name, '==' + pkg.version_req, source=sources[url])
+                cheese._requirements = pkg._requirements
+                required[cheese.key] = cheese
+
+        return required
+
+    def update(self, python_name, sources, toplevel, packages):
+        """Record the result of resolving some groups. toplevel maps each
+        of these groups to the dicts for the "cheesefile" part; packages
+        maps keys to package entries. Packages of other groups are kept.
+
+        The file is only rewritten if something changed. Returns True if
+        it was."""
+
+        groups = set(toplevel.keys())
+        if self.data is None:
+            data = {'format': LOCK_FORMAT, 'cheesefile': {}, 'packages': {}}
+        else:
+            data = json.loads(json.dumps(self.data))
+        data['python'] = python_name
+        data['sources'] = sources
+        data['cheesefile'].update(toplevel)
+
+        for key, entry in data['packages'].items():
+            others = [group for group in entry['groups'] if group not in groups]
+            if others:
+                entry['groups'] = others
+            else:
+                del data['packages'][key]
+        for key, entry in packages.items():
+            old = data['packages'].get(key)
+            if old is not None:
+                entry = dict(entry)
+                entry['groups'] = sorted(set(old['groups']).union(entry['groups']))
+            data['packages'][key] = entry
+
+        text = json.dumps(data, indent=1, sort_keys=True, separators=(',', ': ')) + '\n'
+        if text == self._text:
+            return False
+
+        temp_path = '%s.tmp%d' % (self.path, os.getpid())
+        with file(temp_path, 'wt') as f:
+            f.write(text)
+        os.rename(temp_path, self.path)
+        self._text = text
+        self._parse_json()
+        return True
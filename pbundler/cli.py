@@ -10,16 +10,34 @@ import traceback
 from .bundle import Bundle
 from .exceptions import PBundlerException
 from .cheesefile import Cheesefile
+from .localstore import LocalStore
+from .pack import BundlePack
+from .collector import StoreCollector
+from .mirror import StoreMirror, MirrorServer
+from .timing import profiler
 
 
 USAGE = """
 pbundle                  Copyright 2012,2013 Christian Hofstaedtler
 pbundle Usage:
+  pbundle [--profile file] command ...
+                       - Write a trace of where the time went to file
   pbundle [install]    - Install the packages from Cheesefile
+  pbundle install --from-pack file
+                       - Install from a pack, without network or builds
+  pbundle install --local
+                       - Install, and keep a linked copy in .pbundle/store/
   pbundle update       - Update dependencies to their latest versions
   pbundle init         - Create a basic Cheesefile
   pbundle exec program - Run "program" in activated environment
   pbundle console      - Start an interactive activated python session
+  pbundle verify       - Re-check all downloaded files against their digests
+  pbundle pack [file]  - Write the installed bundle and its lock into file
+  pbundle unpack file  - Add the packages from a pack to the local store
+  pbundle gc [--max-size SIZE] [--max-age DAYS] [--dry-run]
+                       - Remove packages and downloads no project uses
+  pbundle mirror [--bind HOST:PORT] [--upstream URL]
+                       - Serve the local store as a package index
 
 To auto-enable your scripts, use "#!/usr/bin/env pbundle-py" as the
 shebang line. Alternatively:
@@ -43,6 +61,11 @@ class PBCli():
 
     def handle_args(self, argv):
         args = argv[1:]
+        if args[:1] == ['--profile']:
+            if len(args) < 2:
+                raise PBundlerException("Usage: pbundle --profile file [command]")
+            args.pop(0)
+            profiler.enable(args.pop(0))
         command = "install"
         if args:
             command = args.pop(0)
@@ -51,7 +74,8 @@ class PBCli():
         if command == '--version':
             command = 'version'
         if 'cmd_' + command in PBCli.__dict__:
-            return PBCli.__dict__['cmd_' + command](self, args)
+            with profiler.span('pbundle ' + command):
+                return PBCli.__dict__['cmd_' + command](self, args)
         else:
             raise PBundlerException("Could not find command \"%s\"." %
                                              (command,))
@@ -78,11 +102,88 @@ class PBCli():
         Cheesefile.generate_empty_file(path)
 
     def cmd_install(self, args):
-        self.bundle.install(['default'])
+        if args[:1] == ['--from-pack']:
+            if len(args) != 2:
+                raise PBundlerException("Usage: pbundle install --from-pack file")
+            return self.bundle.install_from_pack(args[1])
+        self.bundle.install(['default'], vendor=('--local' in args))
 
     def cmd_update(self, args):
         self.bundle.update()
 
+    def cmd_pack(self, args):
+        if args:
+            path = args[0]
+        else:
+            path = os.path.basename(self.bundle.path) + '-bundle.tar.gz'
+        BundlePack(path).create(self.bundle)
+
+    def cmd_unpack(self, args):
+        if len(args) != 1:
+            raise PBundlerException("Usage: pbundle unpack file")
+        BundlePack(args[0]).extract(LocalStore())
+
+    def cmd_verify(self, args):
+        removed = LocalStore().verify()
+        for filename in removed:
+            print("Removed corrupt download %s" % (filename,))
+        if removed:
+            return 1
+        print("All downloads are intact.")
+
+    def cmd_gc(self, args):
+        max_size, max_age = StoreCollector.configured_limits()
+        dry_run = False
+        while args:
+            arg = args.pop(0)
+            if arg == '--dry-run':
+                dry_run = True
+            elif arg == '--max-size' and args:
+                max_size = StoreCollector.parse_size(args.pop(0))
+            elif arg == '--max-age' and args:
+                max_age = StoreCollector.parse_age(args.pop(0))
+            else:
+                raise PBundlerException("Usage: pbundle gc [--max-size SIZE] [--max-age DAYS] [--dry-run]")
+
+        evicted = StoreCollector(LocalStore()).collect(max_size, max_age, dry_run)
+        for kind, python_name, name, size in evicted:
+            if kind == 'entry':
+                print("Removing %s (%s, %d KB)" % (name, python_name, size // 1024))
+            else:
+                print("Removing download %s (%d KB)" % (name, size // 1024))
+        print("%s %d KB." % (dry_run and "Would free" or "Freed",
+                             sum([size for kind, python_name, name, size in evicted]) // 1024))
+
+    def cmd_mirror(self, args):
+        usage = "Usage: pbundle mirror [--bind HOST:PORT] [--upstream URL]"
+        host, port = '0.0.0.0', MirrorServer.DEFAULT_PORT
+        upstream = None
+        while args:
+            arg = args.pop(0)
+            if arg == '--bind' and args:
+                host, _, port = args.pop(0).rpartition(':')
+                if not port.isdigit():
+                    raise PBundlerException(usage)
+                port = int(port)
+            elif arg == '--upstream' and args:
+                upstream = args.pop(0)
+                if upstream == 'pypi':
+                    upstream = 'http://pypi.python.org/pypi'
+            else:
+                raise PBundlerException(usage)
+
+        localstore = LocalStore()
+        server = MirrorServer(StoreMirror(localstore, upstream), (host or '0.0.0.0', port))
+        print("Serving %s on %s" % (localstore.path, server.url))
+        if upstream:
+            print("Fetching what it doesn't have from %s" % (upstream,))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
     def cmd_exec(self, args):
         return self.bundle.exec_enabled(args)
 
@@ -0,0 +1,165 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+__all__ = ['StoreCollector']
+
+import os
+import time
+import shutil
+
+from . import PBundlerException
+from .cheesefile import CheesefileLock
+from .util import PBDownloader
+from .mergedsite import MergedSite
+
+
+class StoreCollector(object):
+    """Evicts installed entries and downloads from a LocalStore, least
+    recently used first. Works from the store index only.
+
+    Entries referenced by the Cheesefile.lock of a registered project
+    (and the downloads of those entries) are never evicted. Projects
+    whose lock is gone are forgotten.
+
+    Without limits, everything not protected is evicted. With max_age
+    (seconds), everything not used for that long. With max_size
+    (bytes), as much as needed to get the store below that size.
+    """
+
+    def __init__(self, localstore):
+        self.localstore = localstore
+
+    @staticmethod
+    def parse_size(value):
+        """'500M' -> 524288000. Accepts K, M, G and T suffixes."""
+        units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+        value = value.strip().upper().rstrip('B')
+        try:
+            if value and value[-1] in units:
+                return int(float(value[:-1]) * units[value[-1]])
+            return int(value)
+        except ValueError:
+            raise PBundlerException("Invalid size %r." % (value,))
+
+    @staticmethod
+    def parse_age(value):
+        """Days -> seconds."""
+        try:
+            return float(value) * 24 * 60 * 60
+        except ValueError:
+            raise PBundlerException("Invalid age %r (expected days)." % (value,))
+
+    @classmethod
+    def configured_limits(cls):
+        """Returns (max_size, max_age) from PBUNDLER_GC_MAX_SIZE and
+        PBUNDLER_GC_MAX_AGE."""
+        max_size = os.getenv('PBUNDLER_GC_MAX_SIZE')
+        if max_size:
+            max_size = cls.parse_size(max_size)
+        max_age = os.getenv('PBUNDLER_GC_MAX_AGE')
+        if max_age:
+            max_age = cls.parse_age(max_age)
+        return max_size or None, max_age or None
+
+    @classmethod
+    def collect_automatically(cls, localstore):
+        """Collect with the configured limits, if PBUNDLER_GC_AUTO is
+        set and there are any."""
+        if os.getenv('PBUNDLER_GC_AUTO', '') in ['', '0']:
+            return []
+        max_size, max_age = cls.configured_limits()
+        if max_size is None and max_age is None:
+            return []
+        return cls(localstore).collect(max_size, max_age)
+
+    def protected(self):
+        """Entry names referenced by the locks of registered projects."""
+
+        names = set()
+        gone = []
+        for lock_path in self.localstore.index['projects']:
+            if not os.path.exists(lock_path):
+                gone.append(lock_path)
+                continue
+            lock = CheesefileLock(lock_path)
+            try:
+                lock.parse()
+            except Exception as ex:
+                raise PBundlerException("Could not read %s (%s), not collecting anything." %
+                                        (lock_path, ex))
+            for pkgs in lock.from_source_data.values():
+                for pkg in pkgs:
+                    names.add('%s-%s' % (pkg.name, pkg.version_req))
+
+        if gone:
+            def update(index):
+                for lock_path in gone:
+                    index['projects'].pop(lock_path, None)
+            self.localstore._update_index(update)
+        return names
+
+    def candidates(self):
+        """Returns (total size, [(used, size, kind, python_name, name)])
+        of everything in the store that may be evicted, oldest first."""
+
+        protected = self.protected()
+        index = self.localstore.index
+        total = 0
+        candidates = []
+        for python_name, entries in index['entries'].items():
+            for name, info in entries.items():
+                total += info.get('size', 0)
+                if name not in protected:
+                    candidates.append((info.get('used', 0), info.get('size', 0),
+                                       'entry', python_name, name))
+        for filename, info in index['downloads'].items():
+            total += info.get('size', 0)
+            if info.get('entry') not in protected:
+                candidates.append((info.get('used', 0), info.get('size', 0),
+                                   'download', None, filename))
+        candidates.sort()
+        return total, candidates
+
+    def collect(self, max_size=None, max_age=None, dry_run=False):
+        """Evict least recently used entries and downloads. Returns the
+        list of evicted (kind, python_name, name, size)."""
+
+        now = time.time()
+        total, candidates = self.candidates()
+        unlimited = max_size is None and max_age is None
+
+        evicted = []
+        for used, size, kind, python_name, name in candidates:
+            too_old = max_age is not None and now - used > max_age
+            too_big = max_size is not None and total > max_size
+            if not (unlimited or too_old or too_big):
+                # everything after this was used more recently
+                break
+            evicted.append((kind, python_name, name, size))
+            total -= size
+
+        if not dry_run and evicted:
+            self._evict(evicted)
+        return evicted
+
+    def _evict(self, evicted):
+        def update(index):
+            for kind, python_name, name, size in evicted:
+                if kind == 'entry':
+                    index['entries'].get(python_name, {}).pop(name, None)
+                else:
+                    index['downloads'].pop(name, None)
+        # forget them first, so nobody picks them up while they go away
+        self.localstore._update_index(update)
+        MergedSite(self.localstore).remove_using([
+            os.path.join(self.localstore.path, 'cheese', python_name, name, 'lib')
+            for kind, python_name, name, size in evicted if kind == 'entry'])
+
+        for kind, python_name, name, size in evicted:
+            if kind == 'entry':
+                shutil.rmtree(os.path.join(self.localstore.path, 'cheese', python_name, name), True)
+            else:
+                filepath = os.path.join(self.localstore.cache_path, name)
+                for path in [filepath, PBDownloader.sidecar_path(filepath)]:
+                    if os.path.exists(path):
+                        os.unlink(path)
@@ -3,35 +3,128 @@ from __future__ import absolute_import
 
 __all__ = ['DslRunner']
 
+import os
+import sys
+import imp
+import marshal
+import cPickle as pickle
+from hashlib import sha1
+
+from .localstore import LocalStore
+from .timing import profiler
+
 
 class DslRunner(object):
     """Runs Python code in the context of a class.
 
     Public methods will be exposed to the DSL code.
+
+    Compiled code is cached in the store, one entry per file, valid as
+    long as path, mtime and size of the file and the Python version are
+    unchanged. For DSLs without side effects (like Cheesefile.lock),
+    execfile can also cache the resulting context.
     """
 
-    def __init__(self, contextclass):
+    # context class -> names of the methods exposed to the DSL
+    _method_names = {}
+
+    def __init__(self, contextclass, cache_path=None):
         self.contextclass = contextclass
+        if cache_path is None:
+            cache_path = os.path.join(LocalStore.default_path(), 'dsl')
+        self.cache_path = cache_path
 
     def make_context(self):
         ctx = self.contextclass()
-        ctxmap = {}
-        method_names = [fun for fun in ctx.__class__.__dict__ if not fun.startswith('_')]
-        methods = ctx.__class__.__dict__
+        cls = ctx.__class__
+        if cls not in self._method_names:
+            self._method_names[cls] = [fun for fun in cls.__dict__ if not fun.startswith('_')]
+        ctxmap = dict((fun, getattr(ctx, fun)) for fun in self._method_names[cls])
+        return (ctx, ctxmap)
 
-        def method_caller(fun):
-            unbound = methods[fun]
-            def wrapped(*args, **kw):
-                args = (ctx,) + args
-                return unbound(*args, **kw)
-            return wrapped
+    def _cache_name(self, filename, ctx_class):
+        """Depends on the path only, so an outdated entry gets replaced
+        instead of left behind."""
 
-        for fun in method_names:
-            ctxmap[fun] = method_caller(fun)
+        name = '%s\n%s.%s' % (os.path.abspath(filename), ctx_class.__module__, ctx_class.__name__)
+        return sha1(name).hexdigest()
 
-        return (ctx, ctxmap)
+    def _cache_key(self, filename, ctx_class):
+        """Changes whenever the file, the Python version or the module
+        defining the context class change."""
+
+        parts = [imp.get_magic()]
+        for path in [filename, sys.modules[ctx_class.__module__].__file__]:
+            st = os.stat(path)
+            parts.append('%s:%d:%r' % (os.path.abspath(path), st.st_size, st.st_mtime))
+        return sha1('\n'.join(parts)).hexdigest()
+
+    def _read_cache(self, name, key):
+        """Returns the data stored under name, if it was stored with key."""
+
+        try:
+            with file(os.path.join(self.cache_path, name), 'rb') as f:
+                stored_key = f.readline().rstrip('\n')
+                if stored_key != key:
+                    return None
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def _write_cache(self, name, key, data):
+        # the cache is optional; a read-only store just makes us slower.
+        path = os.path.join(self.cache_path, name)
+        temp_path = '%s.tmp%d' % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_path):
+                os.makedirs(self.cache_path)
+            with file(temp_path, 'wb') as f:
+                f.write(key + '\n')
+                f.write(data)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            pass
+
+    def _compile(self, filename, name, key):
+        data = self._read_cache(name + '.code', key)
+        if data is not None:
+            try:
+                code = marshal.loads(data)
+                profiler.count('dsl_code_cache_hits')
+                return code
+            except (EOFError, ValueError, TypeError):
+                pass
+
+        profiler.count('dsl_code_cache_misses')
+        with file(filename, 'rU') as f:
+            code = compile(f.read() + '\n', filename, 'exec')
+        self._write_cache(name + '.code', key, marshal.dumps(code))
+        return code
+
+    def execfile(self, filename, cache_result=False):
+        """Run filename and return the context. With cache_result, the
+        context is pickled and reused as long as the file is unchanged;
+        only use that where running the file has no other effects."""
+
+        with profiler.span('parse', path=filename):
+            ctx, ctxmap = self.make_context()
+            name = self._cache_name(filename, ctx.__class__)
+            key = self._cache_key(filename, ctx.__class__)
+
+            if cache_result:
+                data = self._read_cache(name + '.result', key)
+                if data is not None:
+                    try:
+                        cached = pickle.loads(data)
+                        profiler.count('dsl_result_cache_hits')
+                        return cached
+                    except Exception:
+                        # stale or truncated. run the file.
+                        pass
+
+            code = self._compile(filename, name, key)
+            exec code in {}, ctxmap
 
-    def execfile(self, filename):
-        ctx, ctxmap = self.make_context()
-        execfile(filename, {}, ctxmap)
+            if cache_result:
+                self._write_cache(name + '.result', key, pickle.dumps(ctx, pickle.HIGHEST_PROTOCOL))
         return ctx
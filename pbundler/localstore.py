@@ -4,54 +4,347 @@ from __future__ import absolute_import
 __all__ = ['LocalStore']
 
 import os
+import json
+import shutil
+import time
 import platform
 import pkg_resources
 import glob
 import subprocess
 import sys
 import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
 from . import PBundlerException
-from .util import PBFile, PBArchive
+from .util import PBFile, PBArchive, PBDownloader
+from .metadata import MetadataCache
+from .mergedsite import MergedSite
+from .timing import profiler
 
 
 class LocalStore(object):
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, download_jobs=None):
         if path is None:
-            if os.getenv('PBUNDLER_STORE'):
-                self.path = os.getenv('PBUNDLER_STORE')
-            else:
-                self.path = os.path.expanduser('~/.cache/pbundler/')
+            self.path = self.default_path()
         else:
             self.path = path
 
+        if download_jobs is None:
+            download_jobs = int(os.getenv('PBUNDLER_DOWNLOAD_JOBS', '4'))
+        self.download_jobs = max(1, download_jobs)
+
         PBFile.ensure_dir(self.path)
         self._temp_path = None
+        self._metadata_cache = None
+        self._index = None
+        # builds run in threads and register concurrently
+        self._index_lock = threading.Lock()
         self.python_name = ('%s-%s' % (platform.python_implementation(),
                             ('.'.join(platform.python_version_tuple()[:-1]))))
 
+    @staticmethod
+    def default_path():
+        if os.getenv('PBUNDLER_STORE'):
+            return os.getenv('PBUNDLER_STORE')
+        return os.path.expanduser('~/.cache/pbundler/')
+
     @property
     def cache_path(self):
         path = os.path.join(self.path, 'cache')
         PBFile.ensure_dir(path)
         return path
 
+    @property
+    def metadata_cache(self):
+        if not self._metadata_cache:
+            self._metadata_cache = MetadataCache(os.path.join(self.path, 'metadata'))
+        return self._metadata_cache
+
     @property
     def temp_path(self):
         if not self._temp_path:
             self._temp_path = tempfile.mkdtemp(prefix='pbundle')
         return self._temp_path
 
+    def cleanup(self):
+        """Remove the unpacked sources of this run."""
+        if self._temp_path:
+            shutil.rmtree(self._temp_path, True)
+            self._temp_path = None
+
+    def verify(self):
+        """Re-hash all downloaded files. Corrupt files are removed.
+
+        Returns the list of removed file names."""
+
+        removed = []
+        for filename in sorted(os.listdir(self.cache_path)):
+            filepath = os.path.join(self.cache_path, filename)
+            if (filename.startswith('.') or filename.endswith('.digest') or
+                    '.digest.tmp' in filename or not os.path.isfile(filepath)):
+                continue
+            if not PBDownloader.verify(filepath):
+                os.unlink(filepath)
+                os.unlink(PBDownloader.sidecar_path(filepath))
+                removed.append(filename)
+        return removed
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, 'index.json')
+
+    def _read_index(self):
+        try:
+            with file(self.index_path, 'rt') as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            index = {}
+        for key in ['entries', 'downloads', 'projects']:
+            index.setdefault(key, {})
+        return index
+
+    @property
+    def index(self):
+        """What the store holds. Read once per LocalStore.
+
+        entries: python_name -> entry name -> dict with location,
+          egg_info, project_name, version, requires, size, installed and
+          used (timestamps).
+        downloads: file name in cache_path -> dict with entry (name of
+          the entry it belongs to), size and used.
+        projects: path of a Cheesefile.lock -> time it was registered.
+        """
+        if self._index is None:
+            self._index = self._read_index()
+        return self._index
+
+    def reload_index(self):
+        """Read the index again on next use, to see what other processes
+        changed."""
+        self._index = None
+
+    def _update_index(self, update):
+        """Apply update(index) to the index on disk and atomically
+        replace it."""
+        with self._index_lock:
+            with PBFile.lock(self.index_path + '.lock'):
+                index = self._read_index()
+                update(index)
+                temp_path = '%s.tmp%d' % (self.index_path, os.getpid())
+                with file(temp_path, 'wt') as f:
+                    json.dump(index, f, indent=1, sort_keys=True)
+                os.rename(temp_path, self.index_path)
+                self._index = index
+
+    def entry_name(self, cheese):
+        return '%s-%s' % (cheese.name, cheese.exact_version)
+
+    def _entries(self, index):
+        return index['entries'].setdefault(self.python_name, {})
+
+    def register(self, cheese, dist):
+        """Add an installed dist to the index."""
+
+        lib_path = self.path_for(cheese, 'lib')
+        egg_infos = [name for name in os.listdir(lib_path) if name.endswith('.egg-info')]
+        if len(egg_infos) != 1:
+            # can't describe it. get() will keep scanning for it.
+            return
+        now = time.time()
+        entry = {
+            'location': os.path.relpath(lib_path, self.path),
+            'egg_info': egg_infos[0],
+            'project_name': dist.project_name,
+            'version': dist.version,
+            'requires': [str(req) for req in dist.requires()],
+            'size': PBFile.tree_size(self.path_for(cheese)),
+            'installed': now,
+            'used': now,
+            }
+
+        def update(index):
+            self._entries(index)[self.entry_name(cheese)] = entry
+        self._update_index(update)
+
+    def unregister(self, names):
+        """Remove entries from the index."""
+
+        def update(index):
+            entries = self._entries(index)
+            for name in names:
+                entries.pop(name, None)
+        self._update_index(update)
+
+    def register_downloads(self, filepaths):
+        """Add downloaded files (a dict of Cheese -> file in
+        cache_path) to the index."""
+
+        now = time.time()
+        downloads = {}
+        for cheese, filepath in filepaths.items():
+            downloads[os.path.basename(filepath)] = {
+                'entry': self.entry_name(cheese),
+                'size': os.path.getsize(filepath),
+                'used': now,
+                }
+
+        def update(index):
+            index['downloads'].update(downloads)
+        if downloads:
+            self._update_index(update)
+
+    def register_project(self, lock_path):
+        """Remember a project using this store. Entries its
+        Cheesefile.lock refers to are never garbage collected."""
+
+        lock_path = os.path.abspath(lock_path)
+        if lock_path in self.index['projects']:
+            return
+
+        def update(index):
+            index['projects'][lock_path] = time.time()
+        self._update_index(update)
+
+    # Last use is only recorded this often, so activating a bundle
+    # usually doesn't write anything.
+    TOUCH_INTERVAL = 60 * 60
+
+    def touch(self, cheeses):
+        """Record that the entries of cheeses were just used."""
+
+        now = time.time()
+        names = set([self.entry_name(cheese) for cheese in cheeses])
+        entries = self._entries(self.index)
+        stale = [name for name in names
+                 if name in entries and now - entries[name].get('used', 0) > self.TOUCH_INTERVAL]
+        if not stale:
+            return
+
+        def update(index):
+            entries = self._entries(index)
+            for name in stale:
+                if name in entries:
+                    entries[name]['used'] = now
+            for info in index['downloads'].values():
+                if info['entry'] in names:
+                    info['used'] = now
+        self._update_index(update)
+
+    def _dist_at(self, location, egg_info):
+        location = os.path.join(self.path, location)
+        metadata = pkg_resources.PathMetadata(location, os.path.join(location, egg_info))
+        return pkg_resources.Distribution.from_location(location, egg_info, metadata,
+                                                        precedence=pkg_resources.DEVELOP_DIST)
+
     def get(self, cheese):
+        entry = self.index['entries'].get(self.python_name, {}).get(self.entry_name(cheese))
+        if entry is not None:
+            profiler.count('store_index_hits')
+            return self._dist_at(entry['location'], entry['egg_info'])
+
+        # not indexed yet (older store, or put here by unpack or link_entry)
+        profiler.count('store_scans')
+        return self._scan(cheese)
+
+    def get_recorded(self, cheese, location, egg_info):
+        """The dist of cheese at location (relative to the store) with
+        metadata in egg_info, as a Cheesefile.lock recorded it, without
+        reading the index. None if that is not where this store keeps
+        cheese, or it is gone."""
+
+        if location != os.path.relpath(self.path_for(cheese, 'lib'), self.path):
+            return None
+        if not os.path.isdir(os.path.join(self.path, location, egg_info)):
+            return None
+        profiler.count('store_lock_hits')
+        return self._dist_at(location, egg_info)
+
+    def _scan(self, cheese):
         lib_path = self.path_for(cheese, 'lib')
         if os.path.exists(lib_path):
             dists = [d for d in pkg_resources.find_distributions(lib_path, only=True)]
             if len(dists) == 1:
+                self.register(cheese, dists[0])
                 return dists[0]
 
         return None
 
+    def metadata_path_for(self, cheese):
+        return os.path.join(self.path, 'meta', self.python_name,
+                            '%s-%s.json' % (cheese.name, cheese.exact_version))
+
+    def get_metadata(self, cheese):
+        """Returns the recorded metadata of cheese, or None if we never
+        looked at this version before."""
+
+        try:
+            with file(self.metadata_path_for(cheese), 'rt') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def record_metadata(self, cheese, unpackedsdist):
+        """Remember the requirements of an unpacked sdist, so later runs
+        can resolve it without downloading it again."""
+
+        requires, extras = unpackedsdist.requirements_info()
+        record = {
+            'name': cheese.name,
+            'version': cheese.exact_version,
+            'python_name': self.python_name,
+            'requires': requires,
+            'extras': extras,
+            'digests': unpackedsdist.sdist_digests,
+            }
+        path = self.metadata_path_for(cheese)
+        PBFile.ensure_dir(os.path.dirname(path))
+        temp_path = '%s.tmp%d' % (path, os.getpid())
+        with file(temp_path, 'wt') as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+        os.rename(temp_path, path)
+        return record
+
+    def link_entry(self, cheese, target_store):
+        """Materialize the entry of cheese in target_store, sharing the
+        file data with ours. Returns False if it was already there."""
+
+        target = target_store.path_for(cheese)
+        if os.path.exists(target):
+            return False
+        staging = '%s.tmp%d' % (target, os.getpid())
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        PBFile.link_tree(self.path_for(cheese), staging)
+        os.rename(staging, target)
+        return True
+
+    def remove_entries_except(self, cheeses):
+        """Remove all entries (for our python) except those of cheeses.
+        Returns the number of removed entries."""
+
+        entries_path = os.path.join(self.path, 'cheese', self.python_name)
+        if not os.path.isdir(entries_path):
+            return 0
+        keep = set([os.path.basename(self.path_for(cheese)) for cheese in cheeses])
+        removed = [name for name in os.listdir(entries_path) if name not in keep]
+        if removed:
+            self.unregister(removed)
+            MergedSite(self).remove_using([os.path.join(entries_path, name, 'lib')
+                                           for name in removed])
+        for name in removed:
+            shutil.rmtree(os.path.join(entries_path, name))
+        return len(removed)
+
+    def lock_for(self, cheese):
+        """Context manager serializing work on the entry of cheese,
+        across threads and processes."""
+        return PBFile.lock(os.path.join(self.path, 'locks', self.python_name,
+                                        '%s.lock' % (self.entry_name(cheese),)),
+                           "Waiting for another pbundle installing %s %s..." %
+                           (cheese.name, cheese.exact_version))
+
     def path_for(self, cheese, sub=None):
         path = [self.path, 'cheese', self.python_name,
                 '%s-%s' % (cheese.name, cheese.exact_version)]
@@ -59,32 +352,107 @@ class LocalStore(object):
             path.append(sub)
         return os.path.join(*path)
 
-    def prepare(self, cheese, source):
-        """Download and unpack the cheese."""
+    def download(self, cheeses):
+        """Download the sdists of all cheeses, using up to download_jobs
+        parallel connections, and unpack them for prepare() on the way.
+        Progress is printed in a stable order.
+
+        Returns a dict mapping Cheese.key to the downloaded file."""
+
+        cheeses = sorted(cheeses, key=lambda cheese: cheese.key)
+        if not cheeses:
+            return {}
 
-        print("Downloading %s %s..." % (cheese.name, cheese.exact_version))
+        cache_path = self.cache_path
+
+        # ask each source about all of its files at once
+        sources = []
+        for cheese in cheeses:
+            if cheese.source not in sources:
+                sources.append(cheese.source)
+        for source in sources:
+            source.prefetch_release_urls([cheese for cheese in cheeses if cheese.source is source])
+
+        unpack_paths = dict((cheese.key, self.unpack_path_for(cheese)) for cheese in cheeses)
+
+        def fetch(cheese):
+            return cheese.source.download(cheese, cache_path, unpack_paths[cheese.key])
+
+        print("Downloading %d packages..." % (len(cheeses),))
+        filepaths = {}
+        pool = ThreadPool(min(self.download_jobs, len(cheeses)))
+        try:
+            for num, filepath in enumerate(pool.imap(fetch, cheeses)):
+                cheese = cheeses[num]
+                print("Downloaded %s %s (%d/%d)" % (cheese.name, cheese.exact_version,
+                                                    num + 1, len(cheeses)))
+                filepaths[cheese.key] = filepath
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self.register_downloads(dict((cheese, filepaths[cheese.key]) for cheese in cheeses))
+        return filepaths
+
+    def unpack_path_for(self, cheese):
+        return os.path.join(self.temp_path, cheese.name, cheese.exact_version)
+
+    def prepare(self, cheese, source, sdist_filepath=None):
+        """Unpack the cheese, downloading it first unless sdist_filepath
+        is given. Sources unpacked by download() are used as they are."""
 
         # path we use to install _from_
-        source_path = os.path.join(self.temp_path, cheese.name, cheese.exact_version)
+        source_path = self.unpack_path_for(cheese)
 
-        sdist_filepath = source.download(cheese, self.cache_path)
-        PBArchive(sdist_filepath).unpack(source_path)
+        if sdist_filepath is None:
+            print("Downloading %s %s..." % (cheese.name, cheese.exact_version))
+            sdist_filepath = source.download(cheese, self.cache_path, source_path)
+            self.register_downloads({cheese: sdist_filepath})
+        elif not os.path.isdir(source_path):
+            PBArchive(sdist_filepath).unpack(source_path, strip_first_dir=True)
 
-        # FIXME: ugly hack to get the unpacked dir.
-        # actually we should say unpack(..., strip_first_dir=True)
-        source_path = glob.glob(source_path + '/*')[0]
-        return UnpackedSdist(source_path)
+        unpackedsdist = UnpackedSdist(source_path)
+        unpackedsdist.sdist_digests = PBDownloader.read_sidecar(sdist_filepath)
+        return unpackedsdist
 
-    def install(self, cheese, unpackedsdist):
-        print("Installing %s %s..." % (cheese.name, cheese.exact_version))
-        cheese_path = self.path_for(cheese)
-        lib_path = self.path_for(cheese, 'lib')
-        PBFile.ensure_dir(lib_path)
-        unpackedsdist.run_setup_py(['install',
-               '--root', cheese_path,
-               '--install-lib', 'lib',
-               '--install-scripts', 'bin'], {'PYTHONPATH': lib_path}, "Installing")
-        return self.get(cheese)
+    def install(self, cheese, unpackedsdist, dependency_paths=None):
+        """Build and install the sdist into the store. dependency_paths
+        are made importable for setup.py.
+
+        The entry is built in a staging directory and renamed into place
+        when complete. If another process is installing the same entry,
+        we wait for it and use its result."""
+
+        with profiler.span('install', package=self.entry_name(cheese)), self.lock_for(cheese):
+            # somebody else might have been faster
+            dist = self.get(cheese)
+            if dist is not None:
+                print("Using %s %s" % (cheese.name, cheese.exact_version))
+                return dist
+
+            print("Installing %s %s..." % (cheese.name, cheese.exact_version))
+            cheese_path = self.path_for(cheese)
+            staging_path = '%s.tmp%d' % (cheese_path, os.getpid())
+            if os.path.exists(staging_path):
+                shutil.rmtree(staging_path)
+            lib_path = os.path.join(staging_path, 'lib')
+            PBFile.ensure_dir(lib_path)
+            pythonpath = os.pathsep.join([lib_path] + (dependency_paths or []))
+            try:
+                unpackedsdist.run_setup_py(['install',
+                       '--root', staging_path,
+                       '--install-lib', 'lib',
+                       '--install-scripts', 'bin'], {'PYTHONPATH': pythonpath}, "Installing")
+                if os.path.exists(cheese_path):
+                    # left behind by an older pbundle that failed halfway
+                    shutil.rmtree(cheese_path)
+                os.rename(staging_path, cheese_path)
+            finally:
+                if os.path.exists(staging_path):
+                    shutil.rmtree(staging_path)
+            # the build tree is no longer needed
+            shutil.rmtree(unpackedsdist.path, True)
+            return self._scan(cheese)
 
 
 class UnpackedSdist(object):
@@ -92,30 +460,50 @@ class UnpackedSdist(object):
     def __init__(self, path):
         self.path = path
         self.is_sdist = True
+        self.sdist_digests = None
+        self._requirements_info = None
 
-    def requires(self):
+    def requirements_info(self):
+        """Returns the install requirements (the unnamed section of
+        requires.txt) and a dict of all other sections, as lists of
+        strings. Runs egg_info only once."""
+
+        if self._requirements_info is None:
+            self._requirements_info = self._read_requires_txt()
+        return self._requirements_info
+
+    def _read_requires_txt(self):
         self.run_setup_py(['egg_info'], {}, "Preparing", raise_on_fail=False)
         egg_info_path = glob.glob(self.path + '/*.egg-info')
         if not egg_info_path:
-            return []
+            return [], {}
 
         requires_path = os.path.join(egg_info_path[0], 'requires.txt')
         if not os.path.exists(requires_path):
-            return []
+            return [], {}
 
         requires_raw = []
         with file(requires_path, 'rt') as f:
             requires_raw = f.readlines()
 
-        # requires.txt MAY contain sections, and we ignore all of them except
-        # the unnamed section.
-        sections = [line for line in requires_raw if line.startswith('[')]
-        if sections:
-            requires_raw = requires_raw[0:requires_raw.index(sections[0])]
-        else:
-            requires_raw = requires_raw
+        # requires.txt MAY contain sections. only the unnamed section is
+        # required for installing, the others are extras.
+        requires = []
+        extras = {}
+        section = requires
+        for line in requires_raw:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                section = extras.setdefault(line.strip('[]'), [])
+            else:
+                section.append(line)
+        return requires, extras
 
-        return [req for req in pkg_resources.parse_requirements(requires_raw)]
+    def requires(self):
+        requires, extras = self.requirements_info()
+        return [req for req in pkg_resources.parse_requirements(requires)]
 
     def run_setup_py(self, args, envvars, step, raise_on_fail=True):
         setup_cwd = self.path
@@ -124,7 +512,9 @@ class UnpackedSdist(object):
         if envvars:
             env.update(envvars)
 
-        with tempfile.NamedTemporaryFile() as logfile:
+        profiler.count('subprocesses')
+        with profiler.span('setup.py %s' % (args[0],), path=self.path), \
+                tempfile.NamedTemporaryFile() as logfile:
             proc = subprocess.Popen(cmd,
                                     cwd=setup_cwd,
                                     close_fds=(sys.platform != 'win32'),
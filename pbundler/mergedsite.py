@@ -0,0 +1,137 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+__all__ = ['MergedSite']
+
+import os
+import json
+import shutil
+import filecmp
+from hashlib import sha1
+
+from . import PBundlerException
+from .util import PBFile
+from .timing import profiler
+
+
+# Lists the entries a merged site links to. Not importable.
+MANIFEST = '.pbundle-site.json'
+
+
+class MergedSite(object):
+    """A single directory holding symlinks to the top-level modules and
+    metadata of many installed dists, so activating a bundle adds one
+    sys.path entry instead of one per package.
+
+    Sites live in <store>/sites/<python_name>/<fingerprint>, where the
+    fingerprint is computed from the dist locations. They are built once,
+    by installs, and reused by every bundle with the same packages.
+    Locations and links are relative to the store, so sites keep working
+    when a (project-local) store is moved or copied.
+
+    Directories found in more than one dist (namespace packages) are
+    merged recursively. The same file in two dists is an error, unless
+    both copies are identical. .pth files are left out, like they are
+    when activating dists one by one.
+    """
+
+    def __init__(self, localstore):
+        self.localstore = localstore
+        self.sites_path = os.path.join(localstore.path, 'sites')
+        self.path = os.path.join(self.sites_path, localstore.python_name)
+
+    def _location(self, path):
+        return os.path.relpath(path, self.localstore.path)
+
+    def fingerprint(self, dists):
+        return sha1('\n'.join(sorted([self._location(dist.location) for dist in dists]))).hexdigest()
+
+    def lookup(self, dists):
+        """Returns the merged site for dists, or None if it wasn't built.
+        Writes nothing, so it works on read-only stores."""
+
+        site_path = os.path.join(self.path, self.fingerprint(dists))
+        if os.path.isdir(site_path):
+            return site_path
+        return None
+
+    def path_for(self, dists):
+        """Returns the merged site for dists, building it if needed."""
+
+        site_path = self.lookup(dists)
+        if site_path is not None:
+            return site_path
+        site_path = os.path.join(self.path, self.fingerprint(dists))
+
+        PBFile.ensure_dir(self.path)
+        staging_path = '%s.tmp%d' % (site_path, os.getpid())
+        if os.path.exists(staging_path):
+            shutil.rmtree(staging_path)
+        os.mkdir(staging_path)
+        try:
+            dists = sorted(dists, key=lambda dist: dist.location)
+            with profiler.span('merge site', packages=len(dists)):
+                self._merge([(dist, dist.location) for dist in dists], staging_path, '')
+            with file(os.path.join(staging_path, MANIFEST), 'wt') as f:
+                json.dump([self._location(dist.location) for dist in dists], f, indent=1)
+            try:
+                os.rename(staging_path, site_path)
+            except OSError:
+                # another process built it at the same time
+                if not os.path.isdir(site_path):
+                    raise
+        finally:
+            if os.path.exists(staging_path):
+                shutil.rmtree(staging_path)
+        return site_path
+
+    def _merge(self, sources, target, relpath):
+        """Link everything in the directories of sources, a list of
+        (dist, directory), into target. Links are relative; the site is
+        renamed into place at the same depth."""
+
+        found = {}
+        for dist, directory in sources:
+            for name in os.listdir(directory):
+                if name.endswith('.pth'):
+                    continue
+                found.setdefault(name, []).append((dist, os.path.join(directory, name)))
+
+        for name, candidates in sorted(found.items()):
+            dst = os.path.join(target, name)
+            paths = [path for dist, path in candidates]
+            if len(candidates) == 1:
+                os.symlink(os.path.relpath(paths[0], target), dst)
+            elif all([os.path.isdir(path) for path in paths]):
+                os.mkdir(dst)
+                self._merge(candidates, dst, os.path.join(relpath, name))
+            elif all([os.path.isfile(path) and filecmp.cmp(paths[0], path, shallow=False)
+                      for path in paths]):
+                os.symlink(os.path.relpath(paths[0], target), dst)
+            else:
+                raise PBundlerException("Can't merge %s: %s have different copies of it." % (
+                    os.path.join(relpath, name),
+                    ', '.join(['%s %s' % (dist.project_name, dist.version)
+                               for dist, path in candidates])))
+
+    def remove_using(self, locations):
+        """Remove all sites (of any python) linking to any of
+        locations. Returns the number of removed sites."""
+
+        if not os.path.isdir(self.sites_path):
+            return 0
+        locations = set([self._location(location) for location in locations])
+        removed = 0
+        for python_name in os.listdir(self.sites_path):
+            for name in os.listdir(os.path.join(self.sites_path, python_name)):
+                site_path = os.path.join(self.sites_path, python_name, name)
+                try:
+                    with file(os.path.join(site_path, MANIFEST), 'rt') as f:
+                        used = json.load(f)
+                except (IOError, OSError, ValueError):
+                    # half-built, or not ours
+                    continue
+                if locations.intersection(used):
+                    shutil.rmtree(site_path, True)
+                    removed += 1
+        return removed
@@ -0,0 +1,107 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+__all__ = ['MetadataCache']
+
+import os
+import json
+import time
+import threading
+from hashlib import sha1
+
+from .util import PBFile
+from .timing import profiler
+
+
+class MetadataCache(object):
+    """Remembers answers from package indexes on disk, so unchanged
+    bundles can be installed without asking the index again.
+
+    Keys are tuples like (source_url, method, name[, version]).
+    Entries older than ttl seconds are fetched again, unless they were
+    stored as immutable.
+    """
+
+    DEFAULT_TTL = 24 * 60 * 60
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        if ttl is None:
+            ttl = int(os.getenv('PBUNDLER_METADATA_TTL', self.DEFAULT_TTL))
+        self.ttl = ttl
+        # when set, cached entries are ignored and replaced.
+        self.refresh = False
+        # values fetched or loaded during this run.
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    def _filename(self, key):
+        digest = sha1(json.dumps(key)).hexdigest()
+        return os.path.join(self.path, digest[:2], digest + '.json')
+
+    def lookup(self, key, fresh_only=True):
+        """Returns (found, value). With fresh_only, entries past their
+        ttl are not found."""
+
+        key = list(key)
+        memory_key = json.dumps(key)
+        with self._lock:
+            if memory_key in self._memory:
+                return True, self._memory[memory_key]
+
+        try:
+            with file(self._filename(key), 'rt') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False, None
+
+        if entry.get('key') != key:
+            return False, None
+        if fresh_only and not entry.get('immutable') and time.time() - entry['time'] > self.ttl:
+            return False, None
+
+        with self._lock:
+            self._memory[memory_key] = entry['value']
+        return True, entry['value']
+
+    def store(self, key, value, immutable=False):
+        key = list(key)
+        # round-trip through JSON, so callers get the same types from
+        # memory and from disk.
+        data = json.dumps({'key': key, 'time': time.time(), 'immutable': immutable,
+                           'value': value}, default=str)
+        entry = json.loads(data)
+        with self._lock:
+            self._memory[json.dumps(key)] = entry['value']
+
+        filename = self._filename(key)
+        PBFile.ensure_dir(os.path.dirname(filename))
+        temp_filename = '%s.tmp%d-%d' % (filename, os.getpid(), threading.current_thread().ident)
+        with file(temp_filename, 'wt') as f:
+            f.write(data)
+        os.rename(temp_filename, filename)
+        return entry['value']
+
+    def cached(self, key):
+        """Returns (found, value) for key. When refreshing, only values
+        fetched during this run are found."""
+
+        if not self.refresh:
+            return self.lookup(key)
+
+        memory_key = json.dumps(list(key))
+        with self._lock:
+            if memory_key in self._memory:
+                return True, self._memory[memory_key]
+        return False, None
+
+    def get(self, key, fetch, immutable=False):
+        """Returns the cached value for key, calling fetch() to get it
+        if there is no usable entry."""
+
+        found, value = self.cached(key)
+        if found:
+            profiler.count('metadata_cache_hits')
+            return value
+        profiler.count('metadata_cache_misses')
+        return self.store(key, fetch(), immutable)
@@ -0,0 +1,331 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+__all__ = ['StoreMirror', 'MirrorServer']
+
+import os
+import json
+import time
+import shutil
+import socket
+import httplib
+import threading
+import xmlrpclib
+import pkg_resources
+from SocketServer import ThreadingMixIn
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+from . import PBundlerException
+from .cheesefile import Cheese
+from .sources import CheeseshopSource
+from .util import PBFile, PBDownloader, CHUNK_SIZE
+from .timing import profiler
+
+
+class StoreMirror(object):
+    """Answers the XML-RPC methods CheeseshopSource uses from what a
+    LocalStore has seen: the index answers in its metadata cache, the
+    requirements recorded for its packages, and the sdists in its
+    cache_path.
+
+    With an upstream URL, questions the store can't answer are passed on
+    (and cached like any other answer), and sdists are downloaded into
+    the store on first request. Version lists are then asked upstream,
+    within the metadata cache ttl, falling back to the store if upstream
+    fails.
+    """
+
+    # seconds between looking for packages other processes added
+    RESCAN_INTERVAL = 60
+
+    def __init__(self, localstore, upstream=None):
+        self.localstore = localstore
+        self.upstream = None
+        if upstream is not None:
+            self.upstream = CheeseshopSource(upstream)
+            self.upstream.metadata_cache = localstore.metadata_cache
+        self._lock = threading.Lock()
+        self._scan_done = threading.Condition(self._lock)
+        self._scanning = False
+        # when the last scan finished, None before the first
+        self._scanned = None
+        # (method, name key[, version]) -> answer
+        self._answers = {}
+        # name key -> versions with a download
+        self._downloaded = {}
+        # file name -> (cheese, urlinfo) of files upstream has
+        self._origins = {}
+
+    def _scan(self):
+        """Collect what the store knows, at most every RESCAN_INTERVAL.
+        One thread scans; until the first scan is done, the others wait
+        for it, later they go on with the answers of the previous one."""
+
+        with self._lock:
+            while self._scanning and self._scanned is None:
+                self._scan_done.wait()
+            if self._scanning:
+                return
+            if self._scanned is not None and time.time() - self._scanned < self.RESCAN_INTERVAL:
+                return
+            self._scanning = True
+
+        found = None
+        try:
+            found = self._collect()
+        finally:
+            with self._lock:
+                if found is not None:
+                    answers, downloaded = found
+                    self._answers.update(answers)
+                    self._downloaded = downloaded
+                self._scanned = time.time()
+                self._scanning = False
+                self._scan_done.notify_all()
+
+    def _collect(self):
+        """Returns the answers found in the store, and name key ->
+        version -> file name of its downloads."""
+
+        with profiler.span('scan store'):
+            answers = {}
+            times = {}
+            metadata_path = self.localstore.metadata_cache.path
+            for dirpath, dirnames, filenames in os.walk(metadata_path):
+                for filename in filenames:
+                    if not filename.endswith('.json'):
+                        continue
+                    try:
+                        with file(os.path.join(dirpath, filename), 'rt') as f:
+                            entry = json.load(f)
+                        url, method, name = entry['key'][:3]
+                    except (IOError, OSError, ValueError, KeyError, TypeError):
+                        continue
+                    if method == 'package_releases':
+                        key = (method, name.lower())
+                        answers[key] = sorted(set(answers.get(key, [])).union(entry['value']))
+                    elif method in ('release_data', 'release_urls'):
+                        key = (method, name.lower(), entry['key'][3])
+                        if entry['time'] >= times.get(key, 0):
+                            answers[key] = entry['value']
+                            times[key] = entry['time']
+
+            # packages installed from somewhere else (packs, other
+            # indexes) still have their requirements recorded.
+            meta_path = os.path.join(self.localstore.path, 'meta')
+            for dirpath, dirnames, filenames in os.walk(meta_path):
+                for filename in filenames:
+                    try:
+                        with file(os.path.join(dirpath, filename), 'rt') as f:
+                            record = json.load(f)
+                        key = ('release_data', record['name'].lower(), record['version'])
+                    except (IOError, OSError, ValueError, KeyError):
+                        continue
+                    answers.setdefault(key, {'name': record['name'], 'version': record['version'],
+                                             'requires': record['requires']})
+
+            downloaded = {}
+            self.localstore.reload_index()
+            for filename, info in self.localstore.index['downloads'].items():
+                if not os.path.isfile(os.path.join(self.localstore.cache_path, filename)):
+                    continue
+                name, version = info['entry'].rsplit('-', 1)
+                downloaded.setdefault(name.lower(), {})[version] = filename
+        return answers, downloaded
+
+    def _ask_upstream(self, fetch):
+        """Returns fetch(self.upstream), or None without upstream or if
+        it fails."""
+
+        if self.upstream is None:
+            return None
+        try:
+            return fetch(self.upstream)
+        except (PBundlerException, xmlrpclib.Error, socket.error, httplib.HTTPException) as ex:
+            print("W: %s failed: %s" % (self.upstream.url, ex))
+            return None
+
+    def package_releases(self, name, show_hidden=False):
+        self._scan()
+        versions = self._ask_upstream(lambda src: src.available_versions(Cheese(name, None)))
+        if versions is None:
+            versions = set(self._answers.get(('package_releases', name.lower()), []))
+            versions.update(self._downloaded.get(name.lower(), {}).keys())
+        return sorted(versions, key=pkg_resources.parse_version, reverse=True)
+
+    def release_data(self, name, version):
+        self._scan()
+        data = self._answers.get(('release_data', name.lower(), version))
+        if data is None:
+            requires = self._ask_upstream(lambda src: src.requires(Cheese(name, '==' + version)))
+            if requires is None:
+                # like a missing method, so clients don't take an empty
+                # answer for a release without requirements
+                raise xmlrpclib.Fault(1, "%s %s is not in the store" % (name, version))
+            data = {'name': name, 'version': version, 'requires': requires}
+            with self._lock:
+                self._answers[('release_data', name.lower(), version)] = data
+        return data
+
+    def release_urls(self, name, version, base_url):
+        """The files of a release, pointing at base_url for those we can
+        serve."""
+
+        self._scan()
+        cheese = Cheese(name, '==' + version)
+        urls = self._answers.get(('release_urls', name.lower(), version))
+        if urls is None:
+            urls = self._ask_upstream(lambda src: src.release_urls(cheese))
+        if urls is None:
+            urls = []
+            filename = self._downloaded.get(name.lower(), {}).get(version)
+            if filename is not None:
+                urls.append(self._local_urlinfo(filename))
+
+        result = []
+        for urlinfo in urls:
+            filename = urlinfo['filename']
+            if self.upstream is not None:
+                with self._lock:
+                    self._origins[filename] = (cheese, urlinfo)
+            urlinfo = dict(urlinfo)
+            if self.upstream is not None or self.local_file(filename):
+                urlinfo['url'] = '%s/packages/%s' % (base_url, filename)
+            # else the client has to get it from where the store did
+            result.append(urlinfo)
+        return result
+
+    def _local_urlinfo(self, filename):
+        filepath = os.path.join(self.localstore.cache_path, filename)
+        digests = PBDownloader.read_sidecar(filepath)
+        if digests is None:
+            digests = PBFile.digests(filepath)
+            PBDownloader.write_sidecar(filepath, digests)
+        return {'packagetype': 'sdist', 'filename': filename, 'url': None,
+                'md5_digest': digests['md5'], 'digests': digests,
+                'size': os.path.getsize(filepath)}
+
+    @staticmethod
+    def _servable(filename):
+        return PBFile.is_plain_filename(filename) and not filename.endswith('.digest')
+
+    def local_file(self, filename):
+        """Path of filename in the store, or None."""
+
+        if not self._servable(filename):
+            return None
+        filepath = os.path.join(self.localstore.cache_path, filename)
+        if os.path.isfile(filepath):
+            return filepath
+        return None
+
+    def artifact(self, filename):
+        """Path of filename in the store, downloading it from upstream
+        first if needed. None if we don't have it."""
+
+        filepath = self.local_file(filename)
+        if filepath is not None or self.upstream is None or not self._servable(filename):
+            return filepath
+
+        with self._lock:
+            origin = self._origins.get(filename)
+        if origin is None:
+            return None
+        cheese, urlinfo = origin
+        digest = urlinfo.get('digests', {}).get('sha256')
+        algorithm = 'sha256'
+        if not digest:
+            digest = urlinfo['md5_digest']
+            algorithm = 'md5'
+        filepath = os.path.join(self.localstore.cache_path, filename)
+        try:
+            # concurrent requests for it wait on the download lock
+            PBDownloader.download_checked(urlinfo['url'], filepath, digest, algorithm)
+        except PBundlerException as ex:
+            print("W: %s" % (ex,))
+            return None
+        self.localstore.register_downloads({cheese: filepath})
+        return filepath
+
+
+class MirrorRequestHandler(SimpleXMLRPCRequestHandler):
+    # clients keep their connection open
+    protocol_version = 'HTTP/1.1'
+    # XML-RPC on any path, like .../pypi
+    rpc_paths = ()
+
+    def _base_url(self):
+        host = self.headers.get('Host')
+        if not host:
+            host = '%s:%d' % self.server.server_address
+        return 'http://' + host
+
+    def do_POST(self):
+        self.server.request_state.base_url = self._base_url()
+        SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def do_GET(self):
+        self._send_artifact(True)
+
+    def do_HEAD(self):
+        self._send_artifact(False)
+
+    def _send_artifact(self, with_body):
+        path = self.path.split('?', 1)[0]
+        filepath = None
+        if path.startswith('/packages/'):
+            filepath = self.server.mirror.artifact(path[len('/packages/'):])
+        if filepath is None:
+            self.send_error(404)
+            return
+
+        with file(filepath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            if with_body:
+                self._send_file(f, size)
+
+    def _send_file(self, f, size):
+        sendfile = getattr(os, 'sendfile', None)
+        if sendfile is None:
+            shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+            return
+        # let the kernel copy from the page cache to the socket
+        self.wfile.flush()
+        offset = 0
+        while offset < size:
+            sent = sendfile(self.connection.fileno(), f.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+
+
+class MirrorServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """Serves a StoreMirror: XML-RPC on any path, and sdists under
+    /packages/. Each client connection gets a thread."""
+
+    DEFAULT_PORT = 8141
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, mirror, address):
+        SimpleXMLRPCServer.__init__(self, address, MirrorRequestHandler,
+                                    logRequests=False, allow_none=True)
+        self.mirror = mirror
+        self.request_state = threading.local()
+        self.register_multicall_functions()
+        self.register_function(mirror.package_releases, 'package_releases')
+        self.register_function(mirror.release_data, 'release_data')
+        self.register_function(self.release_urls, 'release_urls')
+
+    @property
+    def url(self):
+        return 'http://%s:%d/pypi' % self.server_address
+
+    def release_urls(self, name, version):
+        return self.mirror.release_urls(name, version, self.request_state.base_url)
@@ -0,0 +1,131 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+__all__ = ['BundlePack']
+
+import os
+import json
+import shutil
+import tarfile
+import tempfile
+from StringIO import StringIO
+
+from . import PBundlerException
+from .cheesefile import CHEESEFILE_LOCK
+from .util import PBFile, PBArchiveGuard
+
+
+PACK_MANIFEST = 'pbundle-pack.json'
+
+
+class BundlePack(object):
+    """A single archive holding the installed store entries of a bundle
+    and its Cheesefile.lock. Extracting it into a store on another host
+    needs no network and no builds.
+
+    Layout: pbundle-pack.json (written first), Cheesefile.lock and
+    store/<store relative path of each entry>.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def create(self, bundle):
+        bundle.load_cheese()
+        localstore = bundle.localstore
+
+        entries = []
+        for pkg in sorted(bundle.required.values(), key=lambda pkg: pkg.key):
+            if pkg.path:
+                # lives in the project, not in the store.
+                continue
+            entry = {'name': pkg.name, 'version': pkg.exact_version,
+                     'path': os.path.relpath(localstore.path_for(pkg), localstore.path)}
+            if os.path.exists(localstore.metadata_path_for(pkg)):
+                entry['meta'] = os.path.relpath(localstore.metadata_path_for(pkg), localstore.path)
+            entries.append(entry)
+        manifest = {'python_name': localstore.python_name, 'entries': entries}
+
+        fd, temp_path = tempfile.mkstemp(prefix='.pbundle-pack', dir=os.path.dirname(os.path.abspath(self.path)))
+        os.close(fd)
+        try:
+            with tarfile.open(temp_path, 'w:gz') as archive:
+                data = json.dumps(manifest, indent=1, sort_keys=True)
+                info = tarfile.TarInfo(PACK_MANIFEST)
+                info.size = len(data)
+                archive.addfile(info, StringIO(data))
+                archive.add(os.path.join(bundle.path, CHEESEFILE_LOCK), CHEESEFILE_LOCK)
+                for entry in entries:
+                    for key in ['path', 'meta']:
+                        if key in entry:
+                            archive.add(os.path.join(localstore.path, entry[key]),
+                                        'store/' + entry[key])
+            os.rename(temp_path, self.path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+        print("Packed %d packages into %s" % (len(entries), self.path))
+        return manifest
+
+    def extract(self, localstore, project_path=None):
+        """Populate localstore with all entries missing from it. Entries
+        already in the store are left alone. If project_path is given,
+        the Cheesefile.lock is written there."""
+
+        with tarfile.open(self.path, 'r:*') as archive:
+            first = archive.next()
+            if first is None or first.name != PACK_MANIFEST:
+                raise PBundlerException("%s is not a pbundle pack." % (self.path,))
+            manifest = json.load(archive.extractfile(first))
+            if manifest['python_name'] != localstore.python_name:
+                raise PBundlerException("%s was packed for %s, but this is %s." %
+                                        (self.path, manifest['python_name'], localstore.python_name))
+
+            # checks paths from the manifest, and every member
+            guard = PBArchiveGuard(os.path.basename(self.path))
+            wanted = []
+            for entry in manifest['entries']:
+                for key in ['path', 'meta']:
+                    if key not in entry:
+                        continue
+                    if guard.check_name(entry[key]) != entry[key]:
+                        raise PBundlerException("Refusing to extract %s from %s." %
+                                                (entry[key], self.path))
+                    if not os.path.exists(os.path.join(localstore.path, entry[key])):
+                        wanted.append(entry[key])
+
+            staging_path = tempfile.mkdtemp(prefix='.pbundle-unpack', dir=localstore.path)
+            try:
+                # entries and records are all three levels deep
+                wanted_set = set(wanted)
+                members = []
+                for member in archive.getmembers():
+                    if not guard.check_tar_member(member):
+                        continue
+                    name = member.name
+                    if name == CHEESEFILE_LOCK and project_path is not None:
+                        members.append(member)
+                    elif name.startswith('store/'):
+                        name = name[len('store/'):]
+                        if '/'.join(name.split('/')[:3]) in wanted_set:
+                            members.append(member)
+                archive.extractall(staging_path, members)
+
+                # move complete entries into place
+                for path in wanted:
+                    target = os.path.join(localstore.path, path)
+                    PBFile.ensure_dir(os.path.dirname(target))
+                    if not os.path.exists(target):
+                        os.rename(os.path.join(staging_path, 'store', path), target)
+
+                if project_path is not None:
+                    shutil.copy(os.path.join(staging_path, CHEESEFILE_LOCK),
+                                os.path.join(project_path, CHEESEFILE_LOCK))
+            finally:
+                shutil.rmtree(staging_path)
+
+        unpacked = [entry for entry in manifest['entries'] if entry['path'] in wanted]
+        print("Unpacked %d of %d packages from %s" % (
+            len(unpacked), len(manifest['entries']), self.path))
+        return manifest
@@ -0,0 +1,292 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+__all__ = ['Resolver']
+
+import pkg_resources
+
+from . import PBundlerException
+from .cheesefile import Cheese
+from .sources import FilesystemSource
+from .timing import profiler
+
+
+class Resolver(object):
+    """Resolves the full set of packages a bundle needs.
+
+    Works in rounds over a worklist of packages that need a version.
+    Each newly discovered requirement is looked at exactly once, and all
+    requirements on the same package are intersected. When a new
+    requirement rules out the version picked earlier, that package is
+    picked again. When no version fits at all, we backtrack by excluding
+    the version of a package that introduced one of the conflicting
+    requirements.
+    """
+
+    # rounds grow with the depth of the dependency graph, so only the
+    # backtracking steps are limited.
+    MAX_BACKTRACKS = 1000
+
+    def __init__(self, sources, localstore):
+        self.sources = sources
+        self.localstore = localstore
+        # (name, version_req) -> Requirement. Parsing them is slow.
+        self._requirements = {}
+        # (Requirement, version) -> bool
+        self._match_memo = {}
+
+    def resolve(self, required):
+        """Resolve required (a dict of Cheese by key, from the Cheesefile)
+        and all of its dependencies. Returns the dict of all Cheese, with
+        versions, sources and dists set. The given Cheese are updated in
+        place."""
+
+        self.required = dict(required)
+        self.toplevel = set(required.keys())
+        # key -> [(key of the requiring package or None, Requirement)]
+        self.constraints = dict((key, [(None, self._requirement(pkg))])
+                                for key, pkg in required.items())
+        # key -> keys that pkg added constraints to
+        self.contributed = {}
+        # key -> version ruled out by backtracking -> keys of the packages
+        # whose pins caused the conflict. Dropped when one of them changes.
+        self.excluded = {}
+        # key -> order in which packages got pinned
+        self.pin_order = {}
+        self.backtracks = 0
+
+        worklist = sorted(self.required.keys())
+        while worklist:
+            keys = sorted(set([key for key in worklist if key in self.required]))
+            worklist = []
+            profiler.count('resolver_rounds')
+            with profiler.span('resolve round', packages=len(keys)):
+                pinned = self._pin(keys, worklist)
+                self._fetch(pinned)
+                for pkg in pinned:
+                    self._add_dependencies(pkg, worklist)
+
+        return self.required
+
+    def _requirement(self, cheese):
+        memo_key = (cheese.name, cheese.version_req)
+        if memo_key not in self._requirements:
+            self._requirements[memo_key] = cheese.requirement()
+        return self._requirements[memo_key]
+
+    def _matches(self, req, version):
+        memo_key = (req, version)
+        if memo_key not in self._match_memo:
+            self._match_memo[memo_key] = version in req
+        return self._match_memo[memo_key]
+
+    def _fits(self, key, version):
+        if version in self.excluded.get(key, ()):
+            return False
+        for parent, req in self.constraints.get(key, []):
+            if not self._matches(req, version):
+                return False
+        return True
+
+    def _is_pinned(self, pkg):
+        return pkg.source is not None
+
+    def _pin(self, keys, worklist):
+        """Pick versions for all keys that need one. Returns the newly
+        pinned Cheese."""
+
+        pinned = []
+        todo = []
+        for key in keys:
+            pkg = self.required.get(key)
+            if pkg is None:
+                # dropped while backtracking
+                continue
+            if pkg.path:
+                if not self._is_pinned(pkg):
+                    self._pin_path(pkg)
+                    pinned.append(pkg)
+                continue
+            if self._is_pinned(pkg):
+                if self._fits(key, pkg.exact_version):
+                    continue
+                self._unpin(pkg, worklist)
+            todo.append(key)
+
+        choices = {}
+        for num, source in enumerate(self.sources):
+            asking = [key for key in todo if key not in choices]
+            if not asking:
+                break
+            # one request for all packages of this round
+            source.prefetch_versions([self.required[key] for key in asking
+                                      if key not in source.version_index])
+            for key in asking:
+                for version in self._candidates(source, key):
+                    choices[key] = (version, source)
+                    break
+
+        for key in todo:
+            pkg = self.required.get(key)
+            if pkg is None:
+                continue
+            if key in choices:
+                pkg.use_from(*choices[key])
+                self.pin_order[key] = len(self.pin_order)
+                pinned.append(pkg)
+            else:
+                self._backtrack(pkg, worklist)
+
+        return [pkg for pkg in pinned if self.required.get(pkg.key) is pkg]
+
+    def _pin_path(self, pkg):
+        source = FilesystemSource(pkg.path)
+        available_versions = source.available_versions(pkg)
+        if len(available_versions) == 0:
+            raise PBundlerException("Package %s is not available in %r" % (pkg.name, pkg.path))
+        if len(available_versions) != 1:
+            raise PBundlerException("Package %s has multiple versions in %r" % (pkg.name, pkg.path))
+
+        pkg.use_from(available_versions[0], source)
+        self.pin_order[pkg.key] = len(self.pin_order)
+
+    def _candidates(self, source, key):
+        """Versions of key on source that fit all requirements, newest
+        first."""
+        reqs = [req for parent, req in self.constraints.get(key, [])]
+        excluded = self.excluded.get(key, ())
+        return [version for version in source.matching_versions(self.required[key], reqs)
+                if version not in excluded]
+
+    def _fetch(self, pinned):
+        """Find dists for all newly pinned packages, or at least their
+        requirements. Packages neither in the store nor seen before are
+        downloaded and unpacked."""
+
+        missing = []
+        for pkg in pinned:
+            if pkg.path:
+                # FIXME: not really the truth
+                dist = pkg.source.get_distribution(pkg)
+                print("Using %s %s from %s" % (pkg.name, pkg.exact_version, pkg.path))
+            else:
+                dist = self.localstore.get(pkg)
+                if dist:
+                    print("Using %s %s" % (pkg.name, pkg.exact_version))
+                else:
+                    record = self.localstore.get_metadata(pkg)
+                    if record is None:
+                        missing.append(pkg)
+                    else:
+                        # seen before. Bundle.install fetches it, if it
+                        # stays in the bundle.
+                        pkg._requirements = [Cheese.from_requirement(req) for req in
+                                             pkg_resources.parse_requirements(record['requires'])]
+                    continue
+            pkg.use_dist(dist)
+
+        # download everything missing in this round at once, then unpack
+        sdist_filepaths = self.localstore.download(missing)
+        for pkg in missing:
+            unpackedsdist = self.localstore.prepare(pkg, pkg.source, sdist_filepaths[pkg.key])
+            self.localstore.record_metadata(pkg, unpackedsdist)
+            pkg.use_dist(unpackedsdist)
+
+    def _add_dependencies(self, pkg, worklist):
+        contributed = []
+        for dep in pkg.requirements:
+            if dep.key == pkg.key:
+                continue
+            contributed.append(dep.key)
+            self.constraints.setdefault(dep.key, []).append((pkg.key, self._requirement(dep)))
+
+            existing = self.required.get(dep.key)
+            if existing is None:
+                self.required[dep.key] = Cheese(dep.name, dep.version_req)
+                worklist.append(dep.key)
+            elif existing.path:
+                # packages from a path win, no matter what.
+                continue
+            elif not self._is_pinned(existing) or not self._fits(dep.key, existing.exact_version):
+                worklist.append(dep.key)
+        self.contributed[pkg.key] = contributed
+
+    def _unpin(self, pkg, worklist):
+        """Forget the version picked for pkg, and the requirements it
+        brought in. Packages nobody requires anymore are dropped."""
+
+        for key in self.contributed.pop(pkg.key, []):
+            constraints = [(parent, req) for (parent, req) in self.constraints.get(key, [])
+                           if parent != pkg.key]
+            self.constraints[key] = constraints
+            if not constraints and key not in self.toplevel and key in self.required:
+                orphan = self.required.pop(key)
+                if self._is_pinned(orphan):
+                    self._unpin(orphan, worklist)
+
+        pkg.source = None
+        pkg.dist = None
+        pkg._requirements = None
+        self.pin_order.pop(pkg.key, None)
+        worklist.append(pkg.key)
+        self._forget_exclusions(pkg.key)
+
+    def _forget_exclusions(self, key):
+        """Allow versions again that were excluded because of the pin of
+        key, which just changed."""
+
+        for excluded in self.excluded.values():
+            for version, causes in excluded.items():
+                if key in causes:
+                    del excluded[version]
+
+    def _has_alternative(self, pkg):
+        """Is there another version of pkg we could try?"""
+
+        for source in self.sources:
+            for version in self._candidates(source, pkg.key):
+                if version != pkg.exact_version:
+                    return True
+        return False
+
+    def _backtrack(self, pkg, worklist):
+        """No version of pkg satisfies all requirements on it. Exclude
+        the version of the most recently pinned package that added one
+        of them and has other versions left, and try again."""
+
+        constraints = self.constraints.get(pkg.key, [])
+        if not any([source.version_index.versions(pkg.key) for source in self.sources]):
+            raise PBundlerException("Package %s %s is not available on any sources." %
+                                    (pkg.name, ','.join([str(req) for parent, req in constraints])))
+
+        parents = [self.required[parent] for parent, req in constraints
+                   if parent is not None and parent in self.required]
+        parents = [parent for parent in parents
+                   if not parent.path and self._is_pinned(parent) and self._has_alternative(parent)]
+        if not parents:
+            reasons = []
+            for parent, req in constraints:
+                if parent is None:
+                    reasons.append('%s (%s)' % (req, 'Cheesefile'))
+                    continue
+                parent_pkg = self.required.get(parent)
+                if parent_pkg is None:
+                    # dropped by an earlier backtrack
+                    continue
+                reasons.append('%s (%s %s)' % (req, parent_pkg.name, parent_pkg.exact_version))
+            raise PBundlerException("Conflicting requirements for %s: %s" %
+                                    (pkg.name, ', '.join(reasons)))
+
+        self.backtracks += 1
+        if self.backtracks > self.MAX_BACKTRACKS:
+            raise PBundlerException("Giving up resolving dependencies after %d conflicts." %
+                                    (self.MAX_BACKTRACKS,))
+        culprit = max(parents, key=lambda parent: self.pin_order[parent.key])
+        print("Conflict on %s, trying another version of %s than %s" %
+              (pkg.name, culprit.name, culprit.exact_version))
+        causes = set([parent for parent, req in constraints
+                      if parent is not None and parent != culprit.key])
+        self.excluded.setdefault(culprit.key, {})[culprit.exact_version] = causes
+        self._unpin(culprit, worklist)
+        if pkg.key in self.required:
+            worklist.append(pkg.key)
@@ -0,0 +1,136 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+__all__ = ['BuildScheduler']
+
+import os
+import multiprocessing
+import threading
+import time
+from Queue import Queue, Empty
+
+
+class BuildScheduler(object):
+    """Installs unpacked sdists into the LocalStore, running independent
+    builds concurrently. A package is built only after all of its
+    dependencies from the same schedule are in the store.
+
+    Each build is a setup.py subprocess, so one thread per running build
+    is enough to keep all cores busy.
+    """
+
+    def __init__(self, localstore, jobs=None):
+        self.localstore = localstore
+        if jobs is None:
+            jobs = int(os.getenv('PBUNDLER_BUILD_JOBS', '0')) or multiprocessing.cpu_count()
+        self.jobs = max(1, jobs)
+        self.timings = {}
+
+    def _dependency_keys(self, pkg, required):
+        return set([dep.key for dep in pkg.requirements
+                    if dep.key in required and dep.key != pkg.key])
+
+    def _dependency_paths(self, pkg, required):
+        """lib paths of all (transitive) dependencies of pkg, so setup.py
+        can import them while building."""
+
+        paths = []
+        seen = set([pkg.key])
+        todo = [pkg]
+        while todo:
+            for key in sorted(self._dependency_keys(todo.pop(0), required)):
+                if key in seen:
+                    continue
+                seen.add(key)
+                dep = required[key]
+                if dep.dist is not None and not getattr(dep.dist, 'is_sdist', False):
+                    paths.append(dep.dist.location)
+                todo.append(dep)
+        return paths
+
+    def _build(self, pkg, paths, results):
+        start = time.time()
+        try:
+            dist = self.localstore.install(pkg, pkg.dist, paths)
+            results.put((pkg.key, dist, None, start, time.time()))
+        except Exception as ex:
+            results.put((pkg.key, None, ex, start, time.time()))
+
+    def run(self, cheeses, required):
+        """Build and install all cheeses (which must carry an unpacked
+        sdist as their dist). required maps keys to all Cheese of the
+        bundle and provides the dependency graph."""
+
+        pending = dict((pkg.key, pkg) for pkg in cheeses)
+        waiting_on = dict((pkg.key, self._dependency_keys(pkg, pending))
+                          for pkg in cheeses)
+        results = Queue()
+        running = {}
+        failures = []
+        started = time.time()
+
+        while pending or running:
+            ready = sorted([key for key in pending if not waiting_on[key]])
+            if not ready and not running:
+                # dependency cycle. break it in a stable way.
+                ready = sorted(pending)[:1]
+
+            while ready and len(running) < self.jobs and not failures:
+                pkg = pending.pop(ready.pop(0))
+                paths = self._dependency_paths(pkg, required)
+                thread = threading.Thread(target=self._build, args=(pkg, paths, results))
+                thread.daemon = True
+                running[pkg.key] = pkg
+                thread.start()
+
+            if not running:
+                break
+
+            try:
+                key, dist, error, start, end = results.get(True, 1)
+            except Empty:
+                continue
+
+            pkg = running.pop(key)
+            if error is not None:
+                failures.append(error)
+                continue
+            pkg.use_dist(dist)  # mark as installed
+            self.timings[key] = (start, end)
+            for deps in waiting_on.values():
+                deps.discard(key)
+
+        if failures:
+            raise failures[0]
+
+        if self.timings:
+            self._report(time.time() - started, required)
+
+    def critical_path(self, required):
+        """Returns (duration, [keys]) of the longest chain of dependent
+        builds of the last run."""
+
+        memo = {}
+
+        def walk(key, visiting):
+            if key in memo:
+                return memo[key]
+            start, end = self.timings[key]
+            best = (0, [])
+            for dep in sorted(self._dependency_keys(required[key], self.timings)):
+                if dep in visiting:
+                    continue
+                chain = walk(dep, visiting | set([key]))
+                if chain[0] > best[0]:
+                    best = chain
+            memo[key] = (best[0] + (end - start), best[1] + [key])
+            return memo[key]
+
+        paths = [walk(key, set()) for key in sorted(self.timings)]
+        return max(paths, key=lambda path: path[0])
+
+    def _report(self, elapsed, required):
+        duration, keys = self.critical_path(required)
+        print("Built %d packages in %.1fs using %d jobs." % (len(self.timings), elapsed, self.jobs))
+        print("Critical path (%.1fs): %s" % (duration, ' -> '.join(
+            [required[key].name for key in keys])))
@@ -1,14 +1,85 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
-__all__ = ['CheeseshopSource']
+__all__ = ['CheeseshopSource', 'SimpleIndexSource', 'DirectorySource', 'FilesystemSource',
+           'VersionIndex']
 
 import os
+import re
+import zlib
+import time
+import bisect
+import socket
+import urllib
+import httplib
+import urlparse
 import pkg_resources
+import threading
 import xmlrpclib
+from HTMLParser import HTMLParser, HTMLParseError
 
 from . import PBundlerException
-from .util import PBDownloader
+from .util import PBFile, PBDownloader
+from .timing import profiler
+
+
+# sdist file names, like foo-1.0.tar.gz
+SDIST_RE = re.compile(r'^(?P<name>.+?)-(?P<version>\d.*?)(?P<ext>\.tar\.gz|\.tgz|\.tar\.bz2|\.zip)$')
+
+
+def normalize_name(name):
+    """The name of a project as PEP 503 spells it. Projects whose names
+    only differ in case, '-', '_' or '.' are the same."""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+class VersionIndex(object):
+    """The versions a source has for each package, parsed and sorted
+    once, so matching requirements is a bisect and a short filter."""
+
+    def __init__(self):
+        # key -> (parsed versions, versions), oldest first
+        self._index = {}
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def add(self, key, versions):
+        pairs = sorted(set([(pkg_resources.parse_version(version), version)
+                            for version in versions]))
+        self._index[key] = ([parsed for parsed, version in pairs],
+                            [version for parsed, version in pairs])
+
+    def versions(self, key):
+        """All versions of key, newest first."""
+        return self._index.get(key, ([], []))[1][::-1]
+
+    def matching(self, key, reqs):
+        """Versions of key that satisfy all reqs, newest first."""
+
+        parsed, versions = self._index.get(key, ([], []))
+        low, high = 0, len(versions)
+        for req in reqs:
+            for op, version in req.specs:
+                if '*' in version:
+                    continue
+                bound = pkg_resources.parse_version(version)
+                if op in ('>=', '=='):
+                    low = max(low, bisect.bisect_left(parsed, bound))
+                if op == '>':
+                    low = max(low, bisect.bisect_right(parsed, bound))
+                if op in ('<=', '=='):
+                    high = min(high, bisect.bisect_right(parsed, bound))
+                if op == '<':
+                    high = min(high, bisect.bisect_left(parsed, bound))
+
+        # the bounds only narrow things down. != and friends are left
+        # to pkg_resources, which takes the already parsed versions.
+        matching = [num for num in range(high - 1, low - 1, -1)
+                    if all([parsed[num] in req for req in reqs])]
+        # final releases before pre-releases
+        matching.sort(key=lambda num: getattr(parsed[num], 'is_prerelease', False))
+        return [versions[num] for num in matching]
 
 
 class CheeseshopSource(object):
@@ -17,29 +88,116 @@ class CheeseshopSource(object):
         self.url = url
         if self.url.endswith('/'):
             self.url = self.url[:-1]
+        # set by the Bundle, to remember answers across runs.
+        self.metadata_cache = None
+        self._local = threading.local()
+        # shared by all packages and resolution rounds of this run
+        self.version_index = VersionIndex()
 
     def _src(self):
-        return xmlrpclib.ServerProxy(self.url, xmlrpclib.Transport())
+        """Returns this thread's ServerProxy. Its transport keeps the
+        HTTP connection open, so we only connect once per source (and
+        thread)."""
+
+        proxy = getattr(self._local, 'proxy', None)
+        if proxy is None:
+            proxy = xmlrpclib.ServerProxy(self.url)
+            self._local.proxy = proxy
+        return proxy
+
+    def _call(self, method, *args, **kw):
+        """Call method on the index, going through the metadata cache.
+        Pass immutable=True for answers that can never change."""
+
+        def fetch():
+            profiler.count('xmlrpc_calls')
+            with profiler.span('xmlrpc', method=method, args=args):
+                return getattr(self._src(), method)(*args)
+        if self.metadata_cache is None:
+            return fetch()
+        key = (self.url, method) + args
+        return self.metadata_cache.get(key, fetch, kw.get('immutable', False))
+
+    def _prefetch(self, method, argss, immutable=False):
+        """Fetch method(*args) for every args tuple without a cached
+        answer, using a single system.multicall request."""
+
+        if self.metadata_cache is None:
+            return
+
+        missing = []
+        for args in argss:
+            if args not in missing and not self.metadata_cache.cached((self.url, method) + args)[0]:
+                missing.append(args)
+        if not missing:
+            return
+
+        multicall = xmlrpclib.MultiCall(self._src())
+        for args in missing:
+            getattr(multicall, method)(*args)
+        try:
+            profiler.count('xmlrpc_calls')
+            with profiler.span('xmlrpc multicall', method=method, calls=len(missing)):
+                results = multicall()
+        except xmlrpclib.Fault:
+            # index without system.multicall. _call will ask one by one.
+            return
+
+        for num, args in enumerate(missing):
+            try:
+                value = results[num]
+            except xmlrpclib.Fault:
+                continue
+            self.metadata_cache.store((self.url, method) + args, value, immutable)
+
+    def prefetch_versions(self, cheeses):
+        """Ask for the versions of all cheeses in one request."""
+        self._prefetch('package_releases', [(cheese.name, True) for cheese in cheeses])
+
+    def prefetch_release_urls(self, cheeses):
+        """Ask for the files of all (pinned) cheeses in one request."""
+        self._prefetch('release_urls', [(cheese.name, cheese.exact_version) for cheese in cheeses],
+                       immutable=True)
 
     def available_versions(self, cheese):
-        versions = self._src().package_releases(cheese.name, True)
+        versions = self._call('package_releases', cheese.name, True)
         return versions
 
+    def matching_versions(self, cheese, reqs):
+        """Versions of cheese satisfying all reqs, newest first."""
+        if cheese.key not in self.version_index:
+            self.version_index.add(cheese.key, self.available_versions(cheese))
+        return self.version_index.matching(cheese.key, reqs)
+
     def requires(self, cheese):
-        d = self._src().release_data(cheese.name, cheese.exact_version)
+        d = self._call('release_data', cheese.name, cheese.exact_version)
         return d["requires"]
 
-    def download(self, cheese, target_path):
-        urls = self._src().release_urls(cheese.name, cheese.exact_version)
+    def release_urls(self, cheese):
+        # files of a released version don't change.
+        return self._call('release_urls', cheese.name, cheese.exact_version, immutable=True)
+
+    def download(self, cheese, target_path, unpack_to=None):
+        """Download the sdist of cheese into target_path. With
+        unpack_to, it is also unpacked there, without its top
+        directory."""
+
+        urls = self.release_urls(cheese)
         filename = None
         url = None
         remote_digest = None
+        algorithm = None
         for urlinfo in urls:
             if urlinfo['packagetype'] != 'sdist':
                 continue
             filename = urlinfo['filename']
             url = urlinfo['url']
-            remote_digest = urlinfo['md5_digest']
+            # prefer sha256 where the index offers it
+            remote_digest = urlinfo.get('digests', {}).get('sha256')
+            algorithm = 'sha256'
+            if not remote_digest:
+                remote_digest = urlinfo['md5_digest']
+                algorithm = 'md5'
             break
 
         if not url:
@@ -48,7 +206,470 @@ class CheeseshopSource(object):
             raise PBundlerException("Did not find an sdist for %s %s on %s" % (cheese.name, cheese.exact_version, self.url))
 
         target_file = os.path.join(target_path, filename)
-        PBDownloader.download_checked(url, target_file, remote_digest)
+        PBDownloader.download_checked(url, target_file, remote_digest, algorithm,
+                                      unpack_to=unpack_to, strip_first_dir=True)
+        return target_file
+
+
+class _LinkParser(HTMLParser):
+    """Collects (url, text) of all links on a page."""
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+        self._href = None
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self._href = dict(attrs).get('href')
+            self._text = []
+
+    def handle_data(self, data):
+        if self._href is not None:
+            self._text.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._href is not None:
+            self.links.append((self._href, ''.join(self._text).strip()))
+            self._href = None
+
+
+class SimpleIndexSource(object):
+    """A package index speaking the simple repository API (PEP 503),
+    like https://pypi.org/simple or a directory of static files behind
+    any web server.
+
+    Project pages are kept in the metadata cache with their ETag and
+    Last-Modified headers. Within the cache ttl they are used as they
+    are; after it, or when updating, they are asked for again with
+    If-None-Match/If-Modified-Since, so an unchanged page costs a 304.
+    HTTP connections are kept open and reused across requests.
+
+    Files are verified with the sha256 or md5 digest in the fragment of
+    their link; files without one are ignored.
+    """
+
+    USER_AGENT = "pbundler (http://github.com/zeha/pbundler/issues)"
+    MAX_REDIRECTS = 5
+
+    def __init__(self, url):
+        self.url = url
+        if self.url.endswith('/'):
+            self.url = self.url[:-1]
+        # set by the Bundle, to remember answers across runs.
+        self.metadata_cache = None
+        self.version_index = VersionIndex()
+        self.jobs = max(1, int(os.getenv('PBUNDLER_DOWNLOAD_JOBS', '4')))
+        self._lock = threading.Lock()
+        # (scheme, host) -> connections not in use
+        self._idle = {}
+        # normalized name -> page of this run
+        self._pages = {}
+
+    def _connection(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=60)
+        return httplib.HTTPConnection(netloc, timeout=60)
+
+    def _release(self, scheme, netloc, connection):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(connection)
+
+    def _request(self, url, headers):
+        """GET url on an idle connection to its host, taken from the pool
+        all threads share (or a new one), following redirects. The
+        connection goes back into the pool after reading the response.
+        Returns (final url, response, body)."""
+
+        for num in range(self.MAX_REDIRECTS + 1):
+            scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+            if query:
+                path += '?' + query
+            # the server may have closed a kept-alive connection. then
+            # we connect again, once.
+            for attempt in (1, 2):
+                connection = self._connection(scheme, netloc)
+                try:
+                    profiler.count('http_requests')
+                    connection.request('GET', path or '/', headers=headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                    self._release(scheme, netloc, connection)
+                    break
+                except (httplib.HTTPException, socket.error) as ex:
+                    connection.close()
+                    if attempt == 2:
+                        raise PBundlerException("Fetching %s failed (%s)" % (url, ex))
+            if response.status not in (301, 302, 303, 307, 308):
+                break
+            url = urlparse.urljoin(url, response.getheader('location'))
+        else:
+            raise PBundlerException("Too many redirects for %s" % (url,))
+
+        if response.getheader('content-encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return url, response, body
+
+    def _parse_page(self, url, body, key):
+        """Returns {version: [[filename, url, algorithm, digest], ...]} of
+        the sdists linked from a project page."""
+
+        parser = _LinkParser()
+        try:
+            parser.feed(body.decode('utf-8', 'replace'))
+            parser.close()
+        except HTMLParseError as ex:
+            raise PBundlerException("Can't parse %s (%s)" % (url, ex))
+
+        releases = {}
+        for href, _ in parser.links:
+            link, fragment = urlparse.urldefrag(urlparse.urljoin(url, href))
+            # the name we store the file under comes from the URL, never
+            # from the link text.
+            filename = os.path.basename(urllib.unquote(urlparse.urlsplit(link).path))
+            if not PBFile.is_plain_filename(filename):
+                continue
+            match = SDIST_RE.match(filename)
+            if not match:
+                continue
+            # versions can start like names do. trust the project name.
+            name_part = filename[:len(key)]
+            if normalize_name(name_part) == key and filename[len(key):len(key) + 1] == '-':
+                version = filename[len(key) + 1:-len(match.group('ext'))]
+            elif normalize_name(match.group('name')) == key:
+                version = match.group('version')
+            else:
+                continue
+            algorithm, _, digest = fragment.partition('=')
+            if algorithm not in ('sha256', 'md5') or not digest:
+                continue
+            releases.setdefault(version, []).append([filename, link, algorithm, digest])
+        return releases
+
+    def _cached_page(self, key):
+        """The page of key from this run or the metadata cache, or None
+        if it has to be fetched."""
+
+        with self._lock:
+            if key in self._pages:
+                return self._pages[key]
+        if self.metadata_cache is None:
+            return None
+        found, page = self.metadata_cache.cached((self.url, 'simple_page', key))
+        if not found:
+            return None
+        profiler.count('metadata_cache_hits')
+        with self._lock:
+            self._pages[key] = page
+        return page
+
+    def _page(self, name):
+        """The releases on the project page of name."""
+
+        key = normalize_name(name)
+        page = self._cached_page(key)
+        if page is not None:
+            return page
+
+        cache_key = (self.url, 'simple_page', key)
+        old = None
+        if self.metadata_cache is not None:
+            profiler.count('metadata_cache_misses')
+            old = self.metadata_cache.lookup(cache_key, fresh_only=False)[1]
+
+        headers = {'User-Agent': self.USER_AGENT, 'Accept': 'text/html',
+                   'Accept-Encoding': 'gzip'}
+        if old:
+            if old.get('etag'):
+                headers['If-None-Match'] = old['etag']
+            if old.get('last_modified'):
+                headers['If-Modified-Since'] = old['last_modified']
+
+        with profiler.span('simple page', project=key):
+            url, response, body = self._request('%s/%s/' % (self.url, key), headers)
+        if response.status == 304 and old:
+            profiler.count('simple_not_modified')
+            page = old
+        elif response.status == 404:
+            page = {'releases': {}}
+        elif response.status == 200:
+            page = {'etag': response.getheader('etag'),
+                    'last_modified': response.getheader('last-modified'),
+                    'releases': self._parse_page(url, body, key)}
+        else:
+            raise PBundlerException("Fetching %s failed (HTTP %d %s)" %
+                                    (url, response.status, response.reason))
+
+        if self.metadata_cache is not None:
+            # also when unchanged, to start its ttl again
+            page = self.metadata_cache.store(cache_key, page)
+        with self._lock:
+            self._pages[key] = page
+        return page
+
+    def prefetch_versions(self, cheeses):
+        """Fetch the project pages of all cheeses, jobs at a time."""
+
+        names = sorted(set([cheese.name for cheese in cheeses
+                            if self._cached_page(normalize_name(cheese.name)) is None]))
+        if len(names) < 2:
+            # not worth starting threads
+            return
+
+        # plain threads: shutting down a ThreadPool takes longer than
+        # a round of 304s.
+        todo = list(reversed(names))
+        errors = []
+
+        def work():
+            while True:
+                try:
+                    name = todo.pop()
+                except IndexError:
+                    return
+                try:
+                    self._page(name)
+                except PBundlerException as ex:
+                    errors.append(ex)
+
+        threads = [threading.Thread(target=work) for num in range(min(self.jobs, len(names)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def prefetch_release_urls(self, cheeses):
+        # the project pages have them
+        self.prefetch_versions(cheeses)
+
+    def available_versions(self, cheese):
+        return self._page(cheese.name)['releases'].keys()
+
+    def matching_versions(self, cheese, reqs):
+        """Versions of cheese satisfying all reqs, newest first."""
+        if cheese.key not in self.version_index:
+            self.version_index.add(cheese.key, self.available_versions(cheese))
+        return self.version_index.matching(cheese.key, reqs)
+
+    def download(self, cheese, target_path, unpack_to=None):
+        """Download the sdist of cheese into target_path. With
+        unpack_to, it is also unpacked there, without its top
+        directory."""
+
+        files = self._page(cheese.name)['releases'].get(cheese.exact_version, [])
+        # .tar.gz over the others
+        files = sorted(files, key=lambda info: not info[0].endswith('.tar.gz'))
+        if not files:
+            raise PBundlerException("Did not find an sdist for %s %s on %s" %
+                                    (cheese.name, cheese.exact_version, self.url))
+        filename, url, algorithm, digest = files[0]
+        if not PBFile.is_plain_filename(filename):
+            # from a page cached by an older version
+            raise PBundlerException("Refusing to download %s from %s." % (filename, self.url))
+
+        target_file = os.path.join(target_path, filename)
+        PBDownloader.download_checked(url, target_file, digest, algorithm,
+                                      unpack_to=unpack_to, strip_first_dir=True)
+        return target_file
+
+
+class DirectorySource(object):
+    """A directory (and its subdirectories) full of sdists, like a
+    local or NFS-mounted wheelhouse.
+
+    The directory is indexed once per run, into name key -> version ->
+    file. The index is kept in the metadata cache, along with the mtime
+    of every directory, so only directories that changed since are
+    listed again, and only new or changed files looked at. Digests are
+    computed when a file is first used, and kept in the index too. The
+    sha256 a release had then is recorded for good, and a file that no
+    longer matches it is refused.
+
+    Wheels and other files are ignored; pbundler builds from sdists.
+    """
+
+    # directories changed less than this many seconds ago are listed
+    # again next time, as their mtime might not change for files added
+    # in the same second.
+    MTIME_GRANULARITY = 2
+
+    def __init__(self, url, base_path=None):
+        """url is a path or file:// URL, relative paths are relative
+        to base_path. It is kept in locks as it is."""
+
+        self.url = url
+        path = url
+        if path.startswith('file://'):
+            path = urllib.url2pathname(path[len('file://'):])
+        path = os.path.expanduser(path)
+        if base_path is not None:
+            path = os.path.join(base_path, path)
+        self.path = os.path.abspath(path)
+        self.metadata_cache = None
+        self.version_index = VersionIndex()
+        self._lock = threading.Lock()
+        self._index = None
+        # name key -> version -> path of the file, relative to self.path
+        self._packages = None
+        self._dirty = False
+
+    def _cache_key(self):
+        return (self.path, 'directory_index')
+
+    def _load(self):
+        """Returns the index, refreshing it on first use."""
+
+        with self._lock:
+            if self._index is not None:
+                return self._index
+
+            old = None
+            if self.metadata_cache is not None:
+                found, old = self.metadata_cache.lookup(self._cache_key(), fresh_only=False)
+            if not old or old.get('format') != 1:
+                old = {'format': 1, 'dirs': {}}
+            # name key==version -> sha256 of the file when first used
+            pinned = old.get('pinned', {})
+
+            with profiler.span('index directory', path=self.path):
+                dirs = {}
+                self._refresh_dir('', old['dirs'], dirs)
+
+            self._index = {'format': 1, 'dirs': dirs, 'pinned': pinned}
+            self._dirty = dirs != old['dirs']
+            self._packages = {}
+            for rel, info in dirs.items():
+                for filename, entry in info['files'].items():
+                    versions = self._packages.setdefault(normalize_name(entry['name']), {})
+                    versions.setdefault(entry['version'], os.path.join(rel, filename))
+            self._save()
+            return self._index
+
+    def _refresh_dir(self, rel, old_dirs, dirs):
+        path = os.path.join(self.path, rel)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            if rel == '':
+                raise PBundlerException("Source directory %s does not exist." % (self.path,))
+            return
+
+        old = old_dirs.get(rel)
+        if old is not None and old['mtime'] == mtime:
+            # nothing was added, removed or renamed in here. files
+            # rewritten in place fail the digest check when copied.
+            info = old
+        else:
+            info = {'mtime': mtime, 'files': {}, 'subdirs': []}
+            if time.time() - mtime < self.MTIME_GRANULARITY:
+                info['mtime'] = None
+            old_files = old and old['files'] or {}
+            for filename in sorted(os.listdir(path)):
+                if filename.startswith('.'):
+                    continue
+                filepath = os.path.join(path, filename)
+                if os.path.isdir(filepath):
+                    info['subdirs'].append(filename)
+                    continue
+                match = SDIST_RE.match(filename)
+                if not match:
+                    continue
+                st = os.stat(filepath)
+                entry = old_files.get(filename)
+                if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+                    entry = {'name': match.group('name'), 'version': match.group('version'),
+                             'size': st.st_size, 'mtime': st.st_mtime, 'digests': None}
+                info['files'][filename] = entry
+        dirs[rel] = info
+
+        for subdir in info['subdirs']:
+            self._refresh_dir(os.path.join(rel, subdir), old_dirs, dirs)
+
+    def _save(self):
+        if self._dirty and self.metadata_cache is not None:
+            self.metadata_cache.store(self._cache_key(), self._index, immutable=True)
+        self._dirty = False
+
+    def _entry(self, cheese):
+        """Returns (relative path, index entry) of the file of cheese."""
+
+        self._load()
+        relpath = self._packages.get(normalize_name(cheese.name), {}).get(cheese.exact_version)
+        if relpath is None:
+            raise PBundlerException("Did not find an sdist for %s %s in %s" %
+                                    (cheese.name, cheese.exact_version, self.path))
+        rel, filename = os.path.split(relpath)
+        return relpath, self._index['dirs'][rel]['files'][filename]
+
+    def _digests(self, cheese):
+        """Returns the path and digests of the file of cheese, which must
+        match the sha256 it had when it was first used."""
+
+        relpath, entry = self._entry(cheese)
+        filepath = os.path.join(self.path, relpath)
+        st = os.stat(filepath)
+        with self._lock:
+            digests = entry['digests']
+            if entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+                digests = None
+        if not digests:
+            digests = PBFile.digests(filepath)
+            with self._lock:
+                entry.update({'size': st.st_size, 'mtime': st.st_mtime, 'digests': digests})
+                self._dirty = True
+
+        key = '%s==%s' % (normalize_name(cheese.name), cheese.exact_version)
+        with self._lock:
+            pinned = self._index['pinned'].get(key)
+            if pinned is None:
+                self._index['pinned'][key] = digests['sha256']
+                self._dirty = True
+            elif pinned != digests['sha256']:
+                raise PBundlerException("%s changed since it was first used (sha256 %s, now %s). "
+                                        "Give the new sdist a new version." %
+                                        (filepath, pinned, digests['sha256']))
+        return filepath, digests
+
+    def prefetch_versions(self, cheeses):
+        self._load()
+
+    def prefetch_release_urls(self, cheeses):
+        """Compute missing digests of all (pinned) cheeses, and save the
+        index once."""
+        for cheese in cheeses:
+            self._digests(cheese)
+        with self._lock:
+            self._save()
+
+    def available_versions(self, cheese):
+        self._load()
+        return self._packages.get(normalize_name(cheese.name), {}).keys()
+
+    def matching_versions(self, cheese, reqs):
+        """Versions of cheese satisfying all reqs, newest first."""
+        if cheese.key not in self.version_index:
+            self.version_index.add(cheese.key, self.available_versions(cheese))
+        return self.version_index.matching(cheese.key, reqs)
+
+    def download(self, cheese, target_path, unpack_to=None):
+        """Copy the sdist of cheese into target_path, checking it against
+        the digest in the index. With unpack_to, it is also unpacked
+        there, without its top directory."""
+
+        filepath, digests = self._digests(cheese)
+        with self._lock:
+            self._save()
+        target_file = os.path.join(target_path, os.path.basename(filepath))
+        PBDownloader.download_checked('file:' + urllib.pathname2url(filepath), target_file,
+                                      digests['sha256'], 'sha256',
+                                      unpack_to=unpack_to, strip_first_dir=True)
         return target_file
 
 
@@ -56,11 +677,16 @@ class FilesystemSource(object):
 
     def __init__(self, path):
         self.path = os.path.expanduser(path)
+        self._dists = None
+
+    @property
+    def dists(self):
+        if self._dists is None:
+            self._dists = list(pkg_resources.find_distributions(self.path, only=True))
+        return self._dists
 
     def available_versions(self, cheese):
-        dists = pkg_resources.find_distributions(self.path, only=True)
-        return [dist.version for dist in dists]
+        return [dist.version for dist in self.dists]
 
     def get_distribution(self, cheese):
-        dists = pkg_resources.find_distributions(self.path, only=True)
-        return [dist for dist in dists][0]
+        return self.dists[0]
@@ -0,0 +1,85 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+__all__ = ['profiler']
+
+import os
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+
+class Profiler(object):
+    """Records timed spans and counters, and writes them as a Chrome
+    trace (load it in chrome://tracing or https://ui.perfetto.dev).
+
+    Does nothing until enabled, either by `pbundle --profile file` or by
+    setting PBUNDLER_PROFILE to a file name. A %p in the file name is
+    replaced by the process id, so processes inheriting the setting
+    don't overwrite each other's traces. Counters are also listed under
+    "counters" in the trace file.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.events = []
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def enable(self, path):
+        if self.path is None:
+            atexit.register(self.write)
+        self.path = path.replace('%p', str(os.getpid()))
+
+    def _now(self):
+        # microseconds, as the trace format wants them
+        return int((time.time() - self._start) * 1000000)
+
+    @contextmanager
+    def span(self, name, category='pbundler', **args):
+        """Record the time spent in the with block."""
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        try:
+            yield
+        finally:
+            event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start,
+                     'dur': self._now() - start, 'pid': os.getpid(),
+                     'tid': threading.current_thread().ident}
+            if args:
+                event['args'] = args
+            with self._lock:
+                self.events.append(event)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self.events.append({'name': name, 'ph': 'C', 'ts': self._now(), 'pid': os.getpid(),
+                                'args': {name: self.counters[name]}})
+
+    def write(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            data = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms',
+                    'otherData': {'counters': dict(self.counters)}}
+        temp_path = '%s.tmp%d' % (self.path, os.getpid())
+        with file(temp_path, 'wt') as f:
+            json.dump(data, f)
+        os.rename(temp_path, self.path)
+
+
+profiler = Profiler()
+if os.getenv('PBUNDLER_PROFILE'):
+    profiler.enable(os.getenv('PBUNDLER_PROFILE'))
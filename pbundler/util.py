@@ -1,22 +1,41 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
-__all__ = ['PBFile', 'PBDownloader', 'PBArchive']
+__all__ = ['PBFile', 'PBDownloader', 'PBArchive', 'PBArchiveGuard']
 
 import os
-from hashlib import md5
+import json
+import posixpath
+import hashlib
 from urllib2 import Request, urlopen
 import subprocess
 import shutil
+import tempfile
 import pkg_resources
 import zipfile
 import tarfile
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from . import PBundlerException
+from .timing import profiler
 
 # Utility functions. Not for public consumption.
 # If you need some of these exposed, please talk to us.
 
+# Files and downloads are read in chunks of this size, so memory use
+# does not depend on the file size.
+CHUNK_SIZE = 64 * 1024
+
+# Digests recorded for every downloaded file.
+DIGEST_ALGORITHMS = ('md5', 'sha256')
+
+# ioctl for copy-on-write file clones (Linux; btrfs, XFS, ...)
+FICLONE = 0x40049409
+
 
 class PBFile(object):
 
@@ -37,57 +56,282 @@ class PBFile(object):
             return None
         return PBFile.find_upwards(fn, up)
 
+    @staticmethod
+    def is_plain_filename(name):
+        """Is name a file name we can put into a directory, as it is? Not
+        a path, not hidden, and not '.' or '..'."""
+        return bool(name) and not (name.startswith('.') or '/' in name or os.sep in name)
+
     @staticmethod
     def ensure_dir(path):
         if not os.path.exists(path):
-            os.makedirs(path)
+            try:
+                os.makedirs(path)
+            except OSError:
+                # somebody else might have been faster
+                if not os.path.isdir(path):
+                    raise
 
     @staticmethod
-    def md5_digest(path):
-        digest = md5()
+    @contextmanager
+    def lock(path, waiting_message=None):
+        """Hold an exclusive lock on path (created if needed) during the
+        with block. Other processes and threads wait for it. Without
+        fcntl, nothing is locked."""
+        PBFile.ensure_dir(os.path.dirname(path))
+        with open(path, 'a') as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    if waiting_message:
+                        print(waiting_message)
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def reflink(src, dst):
+        """Clone src to dst without copying data. Raises IOError or
+        OSError where the filesystem can't do that."""
+        if fcntl is None:
+            raise OSError("reflinks are not supported here")
+        with open(src, 'rb') as s:
+            with open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copystat(src, dst)
+
+    @staticmethod
+    def link_file(src, dst):
+        """Make dst share src's data: a hard link, a reflink, or as a
+        last resort (across filesystems) a copy."""
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+        try:
+            PBFile.reflink(src, dst)
+            return
+        except (IOError, OSError):
+            if os.path.exists(dst):
+                os.unlink(dst)
+        shutil.copy2(src, dst)
+
+    @staticmethod
+    def link_tree(src, dst):
+        """Recreate the tree at src in dst, using link_file for all
+        files. Symlinks are recreated as they are."""
+        for root, dirs, files in os.walk(src):
+            target_root = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+            PBFile.ensure_dir(target_root)
+            for name in dirs[:]:
+                if os.path.islink(os.path.join(root, name)):
+                    os.symlink(os.readlink(os.path.join(root, name)), os.path.join(target_root, name))
+                    dirs.remove(name)
+            for name in files:
+                if os.path.islink(os.path.join(root, name)):
+                    os.symlink(os.readlink(os.path.join(root, name)), os.path.join(target_root, name))
+                else:
+                    PBFile.link_file(os.path.join(root, name), os.path.join(target_root, name))
+
+    @staticmethod
+    def tree_size(path):
+        """Total size of all files below path. Symlinks are not
+        followed."""
+        size = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                size += os.lstat(os.path.join(root, name)).st_size
+        return size
+
+    @staticmethod
+    def digests(path, algorithms=DIGEST_ALGORITHMS):
+        """Returns a dict of algorithm -> hexdigest, computed in a
+        single pass over the file."""
+        hashes = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
         with file(path, 'rb') as f:
-            digest.update(f.read())
-        return digest.hexdigest()
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                for algorithm, digest in hashes:
+                    digest.update(chunk)
+        return dict((algorithm, digest.hexdigest()) for algorithm, digest in hashes)
+
+    @staticmethod
+    def md5_digest(path):
+        return PBFile.digests(path, ['md5'])['md5']
 
 
 class PBDownloader(object):
 
+    @staticmethod
+    def sidecar_path(target_file):
+        return target_file + '.digest'
+
     @classmethod
-    def download_checked(cls, url, target_file, expected_digest):
+    def read_sidecar(cls, target_file):
+        """Returns the digests recorded for target_file, or None if there
+        are none or the file changed since they were recorded."""
+        try:
+            with file(cls.sidecar_path(target_file), 'rt') as f:
+                sidecar = json.load(f)
+            st = os.stat(target_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if sidecar.get('size') != st.st_size or sidecar.get('mtime') != st.st_mtime:
+            return None
+        return sidecar['digests']
+
+    @classmethod
+    def write_sidecar(cls, target_file, digests):
+        st = os.stat(target_file)
+        sidecar = {'size': st.st_size, 'mtime': st.st_mtime, 'digests': digests}
+        temp_file = cls.sidecar_path(target_file) + '.tmp%d' % (os.getpid(),)
+        with file(temp_file, 'wt') as f:
+            json.dump(sidecar, f)
+        os.rename(temp_file, cls.sidecar_path(target_file))
+
+    @classmethod
+    def verify(cls, target_file):
+        """Re-hash target_file and compare with its sidecar. Files without
+        a sidecar get one. Returns False if the file is corrupt."""
+        digests = PBFile.digests(target_file)
+        try:
+            with file(cls.sidecar_path(target_file), 'rt') as f:
+                recorded = json.load(f)['digests']
+        except (IOError, OSError, ValueError, KeyError):
+            cls.write_sidecar(target_file, digests)
+            return True
+        for algorithm, digest in recorded.items():
+            if digests.get(algorithm, digest) != digest:
+                return False
+        cls.write_sidecar(target_file, digests)
+        return True
+
+    @staticmethod
+    def lock_path(target_file):
+        return os.path.join(os.path.dirname(target_file),
+                            '.%s.lock' % (os.path.basename(target_file),))
+
+    @classmethod
+    def download_checked(cls, url, target_file, expected_digest, algorithm='md5',
+                         unpack_to=None, strip_first_dir=False):
+        """Download url to target_file, unless it is there already, and
+        check its digest. With unpack_to, the archive is also unpacked
+        there, straight from the download stream where possible."""
+
+        # one process downloads, the others wait and then use its file.
+        with profiler.span('download', file=os.path.basename(target_file)):
+            with PBFile.lock(cls.lock_path(target_file),
+                             "Waiting for another download of %s..." % (os.path.basename(target_file),)):
+                unpacked = cls._download_checked(url, target_file, expected_digest, algorithm,
+                                                 unpack_to, strip_first_dir)
+        if unpack_to is not None and not unpacked:
+            PBArchive(target_file).unpack(unpack_to, strip_first_dir)
+
+    @classmethod
+    def _download_checked(cls, url, target_file, expected_digest, algorithm,
+                          unpack_to, strip_first_dir):
+        """Returns True if the download got unpacked to unpack_to."""
+
         if os.path.exists(target_file):
-            # file already exists, see if we can use it.
-            if PBFile.md5_digest(target_file) == expected_digest:
+            # file already exists, see if we can use it. trust the sidecar
+            # as long as size and mtime still match.
+            digests = cls.read_sidecar(target_file)
+            if digests is None or algorithm not in digests:
+                digests = PBFile.digests(target_file)
+                if digests[algorithm] == expected_digest:
+                    cls.write_sidecar(target_file, digests)
+            if digests[algorithm] == expected_digest:
                 # local file is ok
-                return
+                profiler.count('download_cache_hits')
+                return False
             else:
                 os.unlink(target_file)
 
         user_agent = ("pbunder/%s " % (cls.my_version) +
                       "(http://github.com/zeha/pbundler/issues)")
 
+        # Stream into a temp file next to the target, hashing (and maybe
+        # unpacking) on the way, and only move it (and what got unpacked)
+        # into place once the digest matched.
+        fd, temp_file = tempfile.mkstemp(prefix='.' + os.path.basename(target_file) + '.',
+                                         dir=os.path.dirname(target_file))
+        hashes = [(name, hashlib.new(name)) for name in DIGEST_ALGORITHMS]
+        unpacked = False
+        staging = None
+        if unpack_to is not None:
+            staging = '%s.tmp%d' % (unpack_to, os.getpid())
+        profiler.count('downloads')
         try:
             req = Request(url)
             req.add_header("User-Agent", user_agent)
             req.add_header("Accept", "*/*")
-            with file(target_file, 'wb') as f:
+            with os.fdopen(fd, 'wb') as f:
                 sock = urlopen(req)
                 try:
-                    f.write(sock.read())
+                    reader = _HashingReader(sock, f, hashes)
+                    if unpack_to is not None and PBArchive(target_file).filetype == 'tar':
+                        try:
+                            PBArchive.unpack_stream(reader, staging, strip_first_dir,
+                                                    os.path.basename(target_file))
+                            unpacked = True
+                        except (tarfile.TarError, IOError, EOFError):
+                            # unpack it again from the file, to report
+                            # the problem if the download is fine.
+                            shutil.rmtree(staging, True)
+                    reader.drain()
                 finally:
                     sock.close()
 
         except Exception as ex:
+            os.unlink(temp_file)
+            if staging is not None:
+                shutil.rmtree(staging, True)
             raise PBundlerException("Downloading %s failed (%s)" % (url, ex))
 
-        local_digest = PBFile.md5_digest(target_file)
+        digests = dict((name, digest.hexdigest()) for name, digest in hashes)
+        local_digest = digests[algorithm]
         if local_digest != expected_digest:
-            os.unlink(target_file)
-            msg = ("Downloading %s failed (MD5 Digest %s did not match expected %s)" %
-                   (url, local_digest, expected_digest))
+            os.unlink(temp_file)
+            if unpacked:
+                shutil.rmtree(staging, True)
+            msg = ("Downloading %s failed (%s Digest %s did not match expected %s)" %
+                   (url, algorithm.upper(), local_digest, expected_digest))
             raise PBundlerException(msg)
-        else:
-            # local file is ok
-            return
+
+        os.chmod(temp_file, 0o644)
+        os.rename(temp_file, target_file)
+        if unpacked:
+            if os.path.exists(unpack_to):
+                shutil.rmtree(unpack_to)
+            os.rename(staging, unpack_to)
+        cls.write_sidecar(target_file, digests)
+        profiler.count('bytes_downloaded', os.path.getsize(target_file))
+        return unpacked
+
+
+class _HashingReader(object):
+    """File-like reader passing everything read from sock on to out
+    and the hashes."""
+
+    def __init__(self, sock, out, hashes):
+        self.sock = sock
+        self.out = out
+        self.hashes = hashes
+
+    def read(self, size=CHUNK_SIZE):
+        chunk = self.sock.read(size)
+        for name, digest in self.hashes:
+            digest.update(chunk)
+        self.out.write(chunk)
+        return chunk
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
 
 try:
     PBDownloader.my_version = pkg_resources.get_distribution('pbundler').version
@@ -105,13 +349,140 @@ class PBArchive(object):
         if self.filetype not in ['zip', 'tar']:
             raise PBundlerException("Unsupported Archive file: %s" % (self.path))
 
-    def unpack(self, destination):
+    @staticmethod
+    def _prepare_destination(destination):
         if os.path.exists(destination):
             shutil.rmtree(destination)
         PBFile.ensure_dir(destination)
-        if self.filetype == 'zip':
-            with zipfile.ZipFile(self.path, 'r') as archive:
-                archive.extractall(destination)
-        elif self.filetype == 'tar':
-            with tarfile.open(self.path, 'r') as archive:
-                archive.extractall(destination)
+
+    @classmethod
+    def unpack_stream(cls, fileobj, destination, strip_first_dir=False, archive_name='archive'):
+        """Unpack a (compressed) tar archive read sequentially from
+        fileobj."""
+        cls._prepare_destination(destination)
+        guard = PBArchiveGuard(archive_name, strip_first_dir)
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for member in archive:
+                if guard.check_tar_member(member):
+                    archive.extract(member, destination)
+
+    def unpack(self, destination, strip_first_dir=False):
+        """Unpack into destination. With strip_first_dir, the top
+        directory found in all sdists is left out."""
+        with profiler.span('unpack', file=os.path.basename(self.path)):
+            self._unpack(destination, strip_first_dir)
+
+    def _unpack(self, destination, strip_first_dir):
+        if self.filetype == 'tar':
+            with file(self.path, 'rb') as f:
+                self.unpack_stream(f, destination, strip_first_dir, os.path.basename(self.path))
+            return
+
+        self._prepare_destination(destination)
+        guard = PBArchiveGuard(os.path.basename(self.path), strip_first_dir)
+        with zipfile.ZipFile(self.path, 'r') as archive:
+            for member in archive.infolist():
+                # zipfile unpacks symlinks as regular files
+                name = guard.check_name(member.filename)
+                if name is None:
+                    continue
+                if member.filename.endswith('/'):
+                    name += '/'
+                member.filename = name
+                archive.extract(member, destination)
+
+
+class PBArchiveGuard(object):
+    """Checks the members of an archive, in archive order, before they
+    are unpacked: names and link targets have to stay inside the
+    destination, and nothing may be unpacked through or onto a symlink
+    from the archive. Refused members raise PBundlerException.
+
+    Paths are archive paths ('/'-separated), relative to the
+    destination. With strip_first_dir, the top directory found in all
+    sdists is left out.
+    """
+
+    def __init__(self, archive_name, strip_first_dir=False):
+        self.archive_name = archive_name
+        self.strip_first_dir = strip_first_dir
+        # symlinks unpacked so far
+        self.symlinks = set()
+        # paths symlink targets go through, which must not become
+        # symlinks later
+        self.link_paths = set()
+
+    def _refuse(self, name, reason):
+        raise PBundlerException("Refusing to unpack %s from %s: %s." %
+                                (name, self.archive_name, reason))
+
+    def _relative(self, member, name):
+        """name relative to the destination, or None for the destination
+        itself (and the stripped top directory)."""
+        normalized = posixpath.normpath(name)
+        if name.startswith('/') or normalized == '..' or normalized.startswith('../'):
+            self._refuse(member, "it is outside of the destination")
+        if self.strip_first_dir:
+            if '/' not in normalized:
+                return None
+            normalized = normalized.split('/', 1)[1]
+        if normalized == '.':
+            return None
+        return normalized
+
+    def _walk(self, member, path, to_link=False):
+        """Returns the paths passed on the way to path, ending with the
+        one path leads to. Refuses paths leaving the destination or
+        going through a symlink; with to_link, path may end at one."""
+        stack = []
+        walked = []
+        for part in path.split('/'):
+            if part in ('', '.'):
+                continue
+            if part == '..':
+                if not stack:
+                    self._refuse(member, "it points outside of the destination")
+                stack.pop()
+            else:
+                stack.append(part)
+            walked.append('/'.join(stack))
+        for num, current in enumerate(walked):
+            if current in self.symlinks and not (to_link and num == len(walked) - 1):
+                self._refuse(member, "it goes through the symlink %s" % (current,))
+        return walked
+
+    def check_name(self, name):
+        """Returns where to put the member called name, relative to the
+        destination, or None if it is left out."""
+        relative = self._relative(name, name)
+        if relative is not None:
+            self._walk(name, relative)
+        return relative
+
+    def check_tar_member(self, member):
+        """Check a TarInfo and make its name (and hard link target)
+        relative to the destination. Returns False if it is left out,
+        like the top directory and device files."""
+        if member.ischr() or member.isblk() or member.isfifo():
+            return False
+        name = self.check_name(member.name)
+        if name is None:
+            return False
+
+        if member.issym():
+            if not member.linkname or member.linkname.startswith('/'):
+                self._refuse(member.name, "its link target is absolute")
+            if name in self.link_paths:
+                self._refuse(member.name, "other links go through it")
+            target = posixpath.join(posixpath.dirname(name), member.linkname)
+            walked = self._walk(member.name, target, to_link=True)
+            self.link_paths.update(walked[:-1])
+            self.symlinks.add(name)
+        elif member.islnk():
+            target = self._relative(member.name, member.linkname)
+            if target is None:
+                self._refuse(member.name, "it links to a directory")
+            self._walk(member.name, target, to_link=True)
+            member.linkname = target
+        member.name = name
+        return True